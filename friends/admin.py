@@ -1,28 +1,172 @@
+from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList, MAX_SHOW_ALL_ALLOWED
+from django.core.paginator import Paginator, InvalidPage
+from django.db import connection, transaction
 
 from friends.models import Contact
 from friends.models import Friendship, FriendshipInvitation, FriendshipInvitationHistory
 from friends.models import JoinInvitation
+from friends.models import ImportJob
+from friends.models import PENDING_STATUSES, set_invitation_status
 
 
-class ContactAdmin(admin.ModelAdmin):
+# unfiltered change lists of tables with more rows than this are paged using
+# the database's estimate of the row count rather than COUNT(*)
+FRIENDS_ADMIN_EXACT_COUNT_LIMIT = getattr(settings, "FRIENDS_ADMIN_EXACT_COUNT_LIMIT", 10000)
+
+
+def estimated_count(model):
+    """
+    Returns the database's estimate of the number of rows in the model's
+    table, or None where there isn't a cheap one.
+    """
+    engine = connection.settings_dict["ENGINE"]
+    table = model._meta.db_table
+    cursor = connection.cursor()
+    if "postgresql" in engine:
+        cursor.execute("SELECT reltuples FROM pg_class WHERE relname = %s", [table])
+    elif "mysql" in engine:
+        cursor.execute("SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s", [table])
+    else:
+        return None
+    row = cursor.fetchone()
+    if row is None or row[0] is None:
+        return None
+    return int(row[0])
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    A paginator which counts unfiltered querysets of large tables from the
+    database's statistics, so the last pages may be a little off.
+    """
+    
+    def _get_count(self):
+        if self._count is None:
+            query = getattr(self.object_list, "query", None)
+            if query is not None and not query.where:
+                estimate = estimated_count(self.object_list.model)
+                if estimate is not None and estimate > FRIENDS_ADMIN_EXACT_COUNT_LIMIT:
+                    self._count = estimate
+        return super(EstimatedCountPaginator, self)._get_count()
+    count = property(_get_count)
+
+
+class EstimatedCountChangeList(ChangeList):
+    
+    def get_results(self, request):
+        # as ChangeList.get_results, with EstimatedCountPaginator counting
+        # both the filtered and the full results
+        paginator = EstimatedCountPaginator(self.query_set, self.list_per_page)
+        result_count = paginator.count
+        if not self.query_set.query.where:
+            full_result_count = result_count
+        else:
+            full_result_count = EstimatedCountPaginator(self.root_query_set, self.list_per_page).count
+        
+        can_show_all = result_count <= MAX_SHOW_ALL_ALLOWED
+        multi_page = result_count > self.list_per_page
+        
+        if (self.show_all and can_show_all) or not multi_page:
+            result_list = self.query_set._clone()
+        else:
+            try:
+                result_list = paginator.page(self.page_num + 1).object_list
+            except InvalidPage:
+                raise IncorrectLookupParameters
+        
+        self.result_count = result_count
+        self.full_result_count = full_result_count
+        self.result_list = result_list
+        self.can_show_all = can_show_all
+        self.multi_page = multi_page
+        self.paginator = paginator
+
+
+class FriendsModelAdmin(admin.ModelAdmin):
+    """
+    Joins just the ``related`` foreign keys into change list queries and
+    pages with EstimatedCountPaginator.
+    """
+    
+    related = ()
+    
+    def queryset(self, request):
+        return super(FriendsModelAdmin, self).queryset(request).select_related(*self.related)
+    
+    def get_changelist(self, request, **kwargs):
+        return EstimatedCountChangeList
+
+
+@transaction.commit_on_success
+def expire_invitations(modeladmin, request, queryset):
+    if queryset.model is FriendshipInvitation:
+        changed = set_invitation_status(queryset.filter(status__in=PENDING_STATUSES), "4")
+    else:
+        changed = queryset.filter(status__in=PENDING_STATUSES).update(status="4")
+    modeladmin.message_user(request, "Expired %d invitations." % changed)
+expire_invitations.short_description = "Expire selected pending invitations"
+
+
+@transaction.commit_on_success
+def decline_invitations(modeladmin, request, queryset):
+    changed = set_invitation_status(queryset.filter(status__in=PENDING_STATUSES), "6")
+    modeladmin.message_user(request, "Declined %d invitations." % changed)
+decline_invitations.short_description = "Mark selected pending invitations declined"
+
+
+@transaction.commit_on_success
+def delete_invitations(modeladmin, request, queryset):
+    if queryset.model is FriendshipInvitation:
+        changed = set_invitation_status(queryset, "8")
+    else:
+        changed = queryset.exclude(status="8").update(status="8")
+    modeladmin.message_user(request, "Marked %d invitations deleted." % changed)
+delete_invitations.short_description = "Mark selected invitations deleted"
+
+
+class ContactAdmin(FriendsModelAdmin):
     list_display = ('id', 'name', 'email', 'user', 'added')
+    related = ('user',)
+    raw_id_fields = ('user', 'users')
 
 
-class FriendshipAdmin(admin.ModelAdmin):
+class FriendshipAdmin(FriendsModelAdmin):
     list_display = ('id', 'from_user', 'to_user', 'added',)
+    related = ('from_user', 'to_user')
+    raw_id_fields = ('from_user', 'to_user')
 
 
-class JoinInvitationAdmin(admin.ModelAdmin):
+class JoinInvitationAdmin(FriendsModelAdmin):
     list_display = ('id', 'from_user', 'contact', 'status')
+    list_filter = ('status', 'sent')
+    related = ('from_user', 'contact')
+    raw_id_fields = ('from_user', 'contact')
+    actions = [expire_invitations, delete_invitations]
 
 
-class FriendshipInvitationAdmin(admin.ModelAdmin):
+class FriendshipInvitationAdmin(FriendsModelAdmin):
     list_display = ('id', 'from_user', 'to_user', 'sent', 'status',)
+    list_filter = ('status', 'sent')
+    related = ('from_user', 'to_user')
+    raw_id_fields = ('from_user', 'to_user')
+    actions = [expire_invitations, decline_invitations, delete_invitations]
 
 
-class FriendshipInvitationHistoryAdmin(admin.ModelAdmin):
+class FriendshipInvitationHistoryAdmin(FriendsModelAdmin):
     list_display = ('id', 'from_user', 'to_user', 'sent', 'status',)
+    list_filter = ('status', 'sent')
+    related = ('from_user', 'to_user')
+    raw_id_fields = ('from_user', 'to_user')
+
+
+class ImportJobAdmin(FriendsModelAdmin):
+    list_display = ('id', 'user', 'source', 'status', 'imported', 'total', 'created', 'finished',)
+    list_filter = ('status', 'source')
+    related = ('user',)
+    raw_id_fields = ('user',)
 
 
 admin.site.register(Contact, ContactAdmin)
@@ -30,3 +174,4 @@ admin.site.register(Friendship, FriendshipAdmin)
 admin.site.register(JoinInvitation, JoinInvitationAdmin)
 admin.site.register(FriendshipInvitation, FriendshipInvitationAdmin)
 admin.site.register(FriendshipInvitationHistory, FriendshipInvitationHistoryAdmin)
+admin.site.register(ImportJob, ImportJobAdmin)
@@ -0,0 +1,136 @@
+"""
+Deferred, batched delivery of the friends_otherconnect notification sent to
+the friends of both users whenever a new friendship is made.
+
+Which executor handles the batches is controlled by FRIENDS_FANOUT_EXECUTOR:
+
+ * friends.fanout.SynchronousExecutor sends each batch immediately (default)
+ * friends.fanout.ThreadPoolExecutor sends batches from a pool of
+   FRIENDS_FANOUT_THREADS background threads
+ * friends.fanout.QueueExecutor stores batches as QueuedNotification rows
+   to be sent by the send_queued_notifications command
+"""
+
+import logging
+import Queue
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.db.models import Q
+from django.utils.importlib import import_module
+
+from django.contrib.auth.models import User
+
+from friends.utils import chunked
+
+if "notification" in settings.INSTALLED_APPS:
+    from notification import models as notification
+else:
+    notification = None
+
+
+FRIENDS_FANOUT_EXECUTOR = getattr(settings, "FRIENDS_FANOUT_EXECUTOR", "friends.fanout.SynchronousExecutor")
+FRIENDS_FANOUT_BATCH_SIZE = getattr(settings, "FRIENDS_FANOUT_BATCH_SIZE", 100)
+FRIENDS_FANOUT_THREADS = getattr(settings, "FRIENDS_FANOUT_THREADS", 4)
+
+
+def deliver(label, recipient_ids, invitation, to_user):
+    """
+    Sends one notification to the given batch of users.
+    """
+    if notification is None:
+        return
+    users = list(User.objects.filter(id__in=recipient_ids))
+    if users:
+        notification.send(users, label, {"invitation": invitation, "to_user": to_user})
+
+
+class SynchronousExecutor(object):
+    
+    def submit(self, label, recipient_ids, invitation, to_user):
+        deliver(label, recipient_ids, invitation, to_user)
+
+
+class ThreadPoolExecutor(object):
+    
+    def __init__(self, workers=FRIENDS_FANOUT_THREADS):
+        self.tasks = Queue.Queue()
+        for i in range(workers):
+            worker = threading.Thread(target=self.work)
+            worker.setDaemon(True)
+            worker.start()
+    
+    def submit(self, label, recipient_ids, invitation, to_user):
+        self.tasks.put((label, recipient_ids, invitation, to_user))
+    
+    def work(self):
+        while True:
+            task = self.tasks.get()
+            try:
+                try:
+                    deliver(*task)
+                except Exception:
+                    logging.exception("friends: failed to deliver %s notifications" % task[0])
+            finally:
+                # each thread has its own connection which would otherwise
+                # stay open between batches
+                connection.close()
+                self.tasks.task_done()
+
+
+class QueueExecutor(object):
+    
+    def submit(self, label, recipient_ids, invitation, to_user):
+        from friends.models import QueuedNotification
+        QueuedNotification.objects.create(
+            label=label,
+            recipients=",".join([str(user_id) for user_id in recipient_ids]),
+            invitation=invitation,
+            to_user=to_user,
+        )
+
+
+_executor = None
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        module_name, class_name = FRIENDS_FANOUT_EXECUTOR.rsplit(".", 1)
+        try:
+            executor_class = getattr(import_module(module_name), class_name)
+        except (ImportError, AttributeError), e:
+            raise ImproperlyConfigured("Error loading fanout executor %s: %s" % (FRIENDS_FANOUT_EXECUTOR, e))
+        _executor = executor_class()
+    return _executor
+
+
+def connection_recipient_ids(user1, user2):
+    """
+    Yields the ids of everyone who is a friend of either user, other than
+    the two users themselves, streamed from a single query.
+    """
+    from friends.models import Friendship
+    excluded = set([user1.pk, user2.pk])
+    seen = set()
+    rows = Friendship.objects.filter(
+        Q(from_user__in=excluded) | Q(to_user__in=excluded)
+    ).values_list("from_user", "to_user").iterator()
+    for from_user_id, to_user_id in rows:
+        for user_id in (from_user_id, to_user_id):
+            if user_id not in excluded and user_id not in seen:
+                seen.add(user_id)
+                yield user_id
+
+
+def notify_connection(invitation, user1, user2, to_user):
+    """
+    Hands friends_otherconnect notifications for the new friendship between
+    the two users to the configured executor, one batch at a time.
+    """
+    if notification is None:
+        return
+    executor = get_executor()
+    for recipient_ids in chunked(connection_recipient_ids(user1, user2), FRIENDS_FANOUT_BATCH_SIZE):
+        executor.submit("friends_otherconnect", recipient_ids, invitation, to_user)
@@ -1,5 +1,6 @@
 from django import forms
 from django.conf import settings
+from django.db import transaction
 
 from django.contrib.auth.models import User
 
@@ -49,26 +50,30 @@ class InviteFriendForm(UserForm):
     
     def clean_to_user(self):
         to_username = self.cleaned_data["to_user"]
+        users = FriendshipInvitation.objects.with_invite_state(self.user, User.objects.filter(username=to_username))
         try:
-            User.objects.get(username=to_username)
+            self.to_user = users.get()
         except User.DoesNotExist:
             raise forms.ValidationError(u"Unknown user.")
             
         return self.cleaned_data["to_user"]
     
     def clean(self):
-        to_user = User.objects.get(username=self.cleaned_data["to_user"])
-        previous_invitations_to = FriendshipInvitation.objects.invitations(to_user=to_user, from_user=self.user)
-        if previous_invitations_to.count() > 0:
+        to_user = getattr(self, "to_user", None)
+        if to_user is None:
+            return self.cleaned_data
+        if to_user.invited:
             raise forms.ValidationError(u"Already requested friendship with %s" % to_user.username)
         # check inverse
-        previous_invitations_from = FriendshipInvitation.objects.invitations(to_user=self.user, from_user=to_user)
-        if previous_invitations_from.count() > 0:
+        if to_user.invited_by:
             raise forms.ValidationError(u"%s has already requested friendship with you" % to_user.username)
+        if to_user.is_friend:
+            raise forms.ValidationError(u"Already friends with %s" % to_user.username)
         return self.cleaned_data
     
+    @transaction.commit_on_success
     def save(self):
-        to_user = User.objects.get(username=self.cleaned_data["to_user"])
+        to_user = self.to_user
         message = self.cleaned_data["message"]
         invitation = FriendshipInvitation(from_user=self.user, to_user=to_user, message=message, status="2")
         invitation.save()
@@ -0,0 +1,267 @@
+"""
+A compact snapshot of the whole friendship graph for offline jobs such as
+friend suggestions, degree distributions, shortest paths and spotting
+rings of spam accounts.
+
+The graph is held in compressed sparse row (CSR) form: the sorted ids of
+every user with at least one friend, an ``offsets`` array and a
+``neighbours`` array, so that the friends of the user at index ``i`` are
+``neighbours[offsets[i]:offsets[i + 1]]`` (as indexes, sorted). This takes
+a few bytes per friendship instead of a model instance.
+
+Requires numpy.
+"""
+
+import struct
+from array import array
+
+import numpy
+
+from django.db.models import signals
+
+from friends.models import Friendship
+
+
+MAGIC = "FGRAPH01"
+HEADER = struct.Struct("<8sqq")
+
+
+class FriendGraph(object):
+    
+    def __init__(self, user_ids, offsets, neighbours):
+        self.user_ids = user_ids
+        self.offsets = offsets
+        self.neighbours = neighbours
+        # friendships made (True) or removed (False) since the snapshot was
+        # built, by (lower id, higher id), folded in the next time the graph
+        # is queried; the latest change to a pair wins
+        self.pending = {}
+    
+    @classmethod
+    def from_edges(cls, from_ids, to_ids):
+        """
+        Builds a graph from two equal-length arrays of user ids, one
+        friendship per position. Duplicates and reversed duplicates are
+        collapsed.
+        """
+        from_ids = numpy.asarray(from_ids, dtype=numpy.int64)
+        to_ids = numpy.asarray(to_ids, dtype=numpy.int64)
+        user_ids = numpy.unique(numpy.concatenate([from_ids, to_ids]))
+        rows = numpy.searchsorted(user_ids, from_ids)
+        cols = numpy.searchsorted(user_ids, to_ids)
+        # each friendship in both directions, sorted by row then column
+        rows, cols = numpy.concatenate([rows, cols]), numpy.concatenate([cols, rows])
+        keys = numpy.unique(rows * len(user_ids) + cols)
+        rows, cols = keys // max(len(user_ids), 1), keys % max(len(user_ids), 1)
+        offsets = numpy.zeros(len(user_ids) + 1, dtype=numpy.int64)
+        offsets[1:] = numpy.cumsum(numpy.bincount(rows, minlength=len(user_ids)))
+        return cls(user_ids, offsets, cols.astype(numpy.int64))
+    
+    @classmethod
+    def from_database(cls):
+        """
+        Builds a graph of every Friendship, streaming the id pairs from the
+        database into compact arrays rather than creating model instances.
+        """
+        from_ids = array("l")
+        to_ids = array("l")
+        for from_user_id, to_user_id in Friendship.objects.values_list("from_user", "to_user").order_by().iterator():
+            from_ids.append(from_user_id)
+            to_ids.append(to_user_id)
+        return cls.from_edges(
+            numpy.frombuffer(from_ids, dtype=numpy.dtype("l")),
+            numpy.frombuffer(to_ids, dtype=numpy.dtype("l")),
+        )
+    
+    def save(self, path):
+        """
+        Writes the graph to the given file in a form ``load`` can map back
+        into memory.
+        """
+        self._refresh()
+        f = open(path, "wb")
+        try:
+            f.write(HEADER.pack(MAGIC, len(self.user_ids), len(self.neighbours)))
+            for values in (self.user_ids, self.offsets, self.neighbours):
+                f.write(numpy.asarray(values, dtype="<i8").tostring())
+        finally:
+            f.close()
+    
+    @classmethod
+    def load(cls, path):
+        """
+        Memory-maps a graph written by ``save``, so only the pages actually
+        used are read from disk.
+        """
+        f = open(path, "rb")
+        try:
+            magic, nodes, edges = HEADER.unpack(f.read(HEADER.size))
+        finally:
+            f.close()
+        if magic != MAGIC:
+            raise ValueError("%s is not a friend graph snapshot" % path)
+        data = numpy.memmap(path, dtype="<i8", mode="r", offset=HEADER.size, shape=(nodes + (nodes + 1) + edges,))
+        return cls(data[:nodes], data[nodes:2 * nodes + 1], data[2 * nodes + 1:])
+    
+    # incremental updates
+    
+    def add_friendship(self, user1_id, user2_id):
+        self.pending[(min(user1_id, user2_id), max(user1_id, user2_id))] = True
+    
+    def remove_friendship(self, user1_id, user2_id):
+        self.pending[(min(user1_id, user2_id), max(user1_id, user2_id))] = False
+    
+    def _friendship_saved(self, sender, instance, created=False, **kwargs):
+        if created:
+            self.add_friendship(instance.from_user_id, instance.to_user_id)
+    
+    def _friendship_deleted(self, sender, instance, **kwargs):
+        self.remove_friendship(instance.from_user_id, instance.to_user_id)
+    
+    def connect(self):
+        """
+        Keeps the graph up to date with Friendship saves and deletes made
+        in this process. Friendship.objects.bulk_befriend and remove_many
+        and the canonicalize_friendships command write without sending
+        these signals, so the graph must be rebuilt after using them.
+        """
+        signals.post_save.connect(self._friendship_saved, sender=Friendship, weak=False, dispatch_uid=("friend_graph_save", id(self)))
+        signals.post_delete.connect(self._friendship_deleted, sender=Friendship, weak=False, dispatch_uid=("friend_graph_delete", id(self)))
+    
+    def disconnect(self):
+        signals.post_save.disconnect(sender=Friendship, dispatch_uid=("friend_graph_save", id(self)))
+        signals.post_delete.disconnect(sender=Friendship, dispatch_uid=("friend_graph_delete", id(self)))
+    
+    def _refresh(self):
+        if not self.pending:
+            return
+        rows = numpy.repeat(numpy.arange(len(self.user_ids)), numpy.diff(self.offsets))
+        cols = numpy.asarray(self.neighbours)
+        once = rows < cols
+        from_ids = numpy.asarray(self.user_ids)[rows[once]]
+        to_ids = numpy.asarray(self.user_ids)[cols[once]]
+        # drop every pair with a pending change, then add back those whose
+        # latest change was an addition
+        changed = numpy.array(self.pending.keys(), dtype=numpy.int64)
+        base = numpy.concatenate([from_ids, to_ids, changed.ravel()]).max() + 1
+        keep = ~numpy.in1d(from_ids * base + to_ids, changed[:, 0] * base + changed[:, 1])
+        added = changed[numpy.array(self.pending.values(), dtype=bool)]
+        from_ids = numpy.concatenate([from_ids[keep], added[:, 0]])
+        to_ids = numpy.concatenate([to_ids[keep], added[:, 1]])
+        graph = FriendGraph.from_edges(from_ids, to_ids)
+        self.user_ids, self.offsets, self.neighbours = graph.user_ids, graph.offsets, graph.neighbours
+        self.pending = {}
+    
+    # queries
+    
+    def _index(self, user_id):
+        i = numpy.searchsorted(self.user_ids, user_id)
+        if i < len(self.user_ids) and self.user_ids[i] == user_id:
+            return i
+        return None
+    
+    def _row(self, i):
+        return self.neighbours[self.offsets[i]:self.offsets[i + 1]]
+    
+    def degrees(self):
+        """
+        Returns a tuple of (user ids, number of friends) arrays for every
+        user with at least one friend.
+        """
+        self._refresh()
+        return self.user_ids, numpy.diff(self.offsets)
+    
+    def degree(self, user_id):
+        self._refresh()
+        i = self._index(user_id)
+        if i is None:
+            return 0
+        return int(self.offsets[i + 1] - self.offsets[i])
+    
+    def friend_ids(self, user_id):
+        self._refresh()
+        i = self._index(user_id)
+        if i is None:
+            return numpy.zeros(0, dtype=numpy.int64)
+        return self.user_ids[self._row(i)]
+    
+    def are_friends(self, user1_id, user2_id):
+        self._refresh()
+        i, j = self._index(user1_id), self._index(user2_id)
+        if i is None or j is None:
+            return False
+        row = self._row(i)
+        k = numpy.searchsorted(row, j)
+        return bool(k < len(row) and row[k] == j)
+    
+    def mutual_count(self, user1_id, user2_id):
+        self._refresh()
+        i, j = self._index(user1_id), self._index(user2_id)
+        if i is None or j is None:
+            return 0
+        return len(numpy.intersect1d(self._row(i), self._row(j), assume_unique=True))
+    
+    def mutual_counts(self, user_id):
+        """
+        Returns a tuple of (user ids, mutual friend count) arrays for every
+        friend of a friend of the given user who isn't already their friend,
+        most mutual friends first.
+        """
+        self._refresh()
+        i = self._index(user_id)
+        if i is None:
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+        friends = self._row(i)
+        counts = numpy.bincount(self._gather(friends), minlength=len(self.user_ids))
+        counts[friends] = 0
+        counts[i] = 0
+        candidates = numpy.nonzero(counts)[0]
+        order = numpy.argsort(-counts[candidates], kind="mergesort")
+        return self.user_ids[candidates[order]], counts[candidates[order]]
+    
+    def distances(self, user_id, max_depth=None):
+        """
+        Breadth-first search from the given user. Returns a tuple of (user
+        ids, hops) arrays for every user reachable within ``max_depth``
+        hops, nearest first.
+        """
+        self._refresh()
+        start = self._index(user_id)
+        if start is None:
+            return numpy.array([user_id], dtype=numpy.int64), numpy.zeros(1, dtype=numpy.int64)
+        hops = numpy.empty(len(self.user_ids), dtype=numpy.int64)
+        hops.fill(-1)
+        hops[start] = 0
+        frontier = numpy.array([start])
+        depth = 0
+        while len(frontier) and (max_depth is None or depth < max_depth):
+            depth += 1
+            reached = numpy.unique(self._gather(frontier))
+            frontier = reached[hops[reached] < 0]
+            hops[frontier] = depth
+        found = numpy.nonzero(hops >= 0)[0]
+        order = numpy.argsort(hops[found], kind="mergesort")
+        return self.user_ids[found[order]], hops[found[order]]
+    
+    def distance(self, user1_id, user2_id, max_depth=None):
+        """
+        Returns the number of hops between the two users, or None if they
+        aren't connected within ``max_depth`` hops.
+        """
+        user_ids, hops = self.distances(user1_id, max_depth)
+        found = numpy.nonzero(user_ids == user2_id)[0]
+        if len(found):
+            return int(hops[found[0]])
+        return None
+    
+    def _gather(self, rows):
+        """
+        Returns the concatenated neighbours of the given row indexes.
+        """
+        starts = self.offsets[rows]
+        lengths = self.offsets[rows + 1] - starts
+        total = lengths.sum()
+        if not total:
+            return numpy.zeros(0, dtype=numpy.int64)
+        shift = numpy.repeat(starts - (numpy.cumsum(lengths) - lengths), lengths)
+        return numpy.asarray(self.neighbours)[shift + numpy.arange(total)]
@@ -1,56 +1,174 @@
+import Queue
+import threading
+
 from django.conf import settings
+from django.core.validators import email_re
+from django.db import transaction
 from django.utils import simplejson as json
 
 import gdata.contacts.service
 import vobject
 import ybrowserauth
 
-from friends.models import Contact
+from friends.instrumentation import instrumented
+from friends.models import Contact, FriendStats, ImportJob
+from friends.utils import bulk_insert, chunked, normalize_email
+
+
+# number of new contacts written per INSERT
+FRIENDS_IMPORT_BATCH_SIZE = getattr(settings, "FRIENDS_IMPORT_BATCH_SIZE", 500)
+
+# number of fetched Google Contacts pages held in memory waiting to be imported
+FRIENDS_IMPORT_MAX_PAGES = getattr(settings, "FRIENDS_IMPORT_MAX_PAGES", 2)
+
+
+class ImportResult(tuple):
+    """
+    The ``(imported, total)`` tuple returned by the importers, which also
+    records how many entries were skipped as ``duplicates`` (already a
+    contact or repeated in the import) or ``invalid`` (no usable email).
+    """
+    
+    def __new__(cls, imported, total, duplicates=0, invalid=0):
+        result = tuple.__new__(cls, (imported, total))
+        result.duplicates = duplicates
+        result.invalid = invalid
+        return result
+    
+    @property
+    def imported(self):
+        return self[0]
+    
+    @property
+    def total(self):
+        return self[1]
 
 
-def import_vcards(stream, user):
+class ContactImporter(object):
+    """
+    Collects the entries of an import for a user, skipping invalid and
+    duplicate addresses, and writes the new contacts in bulk.
+    
+    The user's existing contact emails are fetched once up front so
+    deduplication needs no further queries.
+    """
+    
+    def __init__(self, user, batch_size=FRIENDS_IMPORT_BATCH_SIZE):
+        self.user = user
+        self.batch_size = batch_size
+        self.seen = set(Contact.objects.filter(user=user).values_list("normalized_email", flat=True).iterator())
+        self.pending = []
+        self.imported = 0
+        self.total = 0
+        self.duplicates = 0
+        self.invalid = 0
+    
+    def add(self, name, email):
+        self.total += 1
+        email = (email or "").strip()
+        if not email_re.match(email):
+            self.invalid += 1
+            return
+        normalized = normalize_email(email)
+        if normalized in self.seen:
+            self.duplicates += 1
+            return
+        self.seen.add(normalized)
+        self.pending.append(Contact(user=self.user, name=name, email=email))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+    
+    def flush(self):
+        if self.pending:
+            bulk_insert(Contact, self.pending, self.batch_size)
+            FriendStats.objects.adjust(self.user.pk, contacts=len(self.pending))
+            self.imported += len(self.pending)
+            self.pending = []
+    
+    def result(self):
+        return ImportResult(self.imported, self.total, self.duplicates, self.invalid)
+    
+    def finish(self):
+        self.flush()
+        return self.result()
+
+
+def _card_value(card, name):
+    try:
+        return getattr(card, name).value
+    except AttributeError:
+        return None
+
+
+@transaction.commit_on_success
+def _import_cards(importer, cards):
+    for card in cards:
+        name = _card_value(card, "fn")
+        emails = card.contents.get("email")
+        if not emails:
+            importer.add(name, None)
+        for email in emails or []:
+            importer.add(name, email.value)
+    importer.flush()
+
+
+def iter_import_vcards(stream, user, batch_size=FRIENDS_IMPORT_BATCH_SIZE):
+    """
+    Imports the given vcard stream into the contacts of the given user,
+    parsing and committing ``batch_size`` cards at a time so memory use
+    doesn't grow with the size of the stream.
+    
+    Yields an ImportResult with the running totals after each batch.
+    """
+    
+    importer = ContactImporter(user, batch_size)
+    for cards in chunked(vobject.readComponents(stream), batch_size):
+        _import_cards(importer, cards)
+        yield importer.result()
+
+
+@instrumented("import_vcards")
+def import_vcards(stream, user, progress=None, batch_size=FRIENDS_IMPORT_BATCH_SIZE):
     """
     Imports the given vcard stream into the contacts of the given user.
+    Every email address on a card is imported.
+    
+    If given, ``progress`` is called with the running ImportResult after
+    each batch of cards is committed.
     
-    Returns a tuple of (number imported, total number of cards).
+    Returns an ImportResult tuple of (number imported, total number of
+    addresses).
     """
     
-    total = 0
-    imported = 0
-    for card in vobject.readComponents(stream):
-        total += 1
-        try:
-            name = card.fn.value
-            email = card.email.value
-            try:
-                Contact.objects.get(user=user, email=email)
-            except Contact.DoesNotExist:
-                Contact(user=user, name=name, email=email).save()
-                imported += 1
-        except AttributeError:
-            pass # missing value so don't add anything
-    return imported, total
+    result = ImportResult(0, 0)
+    for result in iter_import_vcards(stream, user, batch_size):
+        if progress is not None:
+            progress(result)
+    return result
 
 
-def import_yahoo(bbauth_token, user):
+@instrumented("import_yahoo")
+@transaction.commit_on_success
+def import_yahoo(bbauth_token, user, ybbauth=None):
     """
     Uses the given BBAuth token to retrieve a Yahoo Address Book and
     import the entries with an email address into the contacts of the
     given user.
     
-    Returns a tuple of (number imported, total number of entries).
+    ``ybbauth`` may be given in place of a BBAuth token.
+    
+    Returns an ImportResult tuple of (number imported, total number of entries).
     """
     
-    ybbauth = ybrowserauth.YBrowserAuth(settings.BBAUTH_APP_ID, settings.BBAUTH_SHARED_SECRET)
-    ybbauth.token = bbauth_token
+    if ybbauth is None:
+        ybbauth = ybrowserauth.YBrowserAuth(settings.BBAUTH_APP_ID, settings.BBAUTH_SHARED_SECRET)
+        ybbauth.token = bbauth_token
     address_book_json = ybbauth.makeAuthWSgetCall("http://address.yahooapis.com/v1/searchContacts?format=json&email.present=1&fields=name,email")
     address_book = json.loads(address_book_json)
     
-    total = 0
-    imported = 0
+    importer = ContactImporter(user)
     
     for contact in address_book["contacts"]:
-        total += 1
         email = contact['fields'][0]['data']
         try:
             first_name = contact['fields'][1]['first']
@@ -68,45 +186,158 @@ def import_yahoo(bbauth_token, user):
             name = last_name
         else:
             name = None
+        importer.add(name, email)
+    
+    return importer.finish()
+
+
+class FeedPageFetcher(threading.Thread):
+    """
+    Fetches the pages of a Google Contacts feed in a background thread,
+    holding at most ``max_pages`` fetched pages until they are consumed.
+    
+    Each page is queued as an ``(entries, next_href, error)`` tuple, the
+    last one having no ``next_href``.
+    """
+    
+    def __init__(self, contacts_service, uri=None, max_pages=FRIENDS_IMPORT_MAX_PAGES):
+        super(FeedPageFetcher, self).__init__()
+        self.setDaemon(True)
+        self.contacts_service = contacts_service
+        self.uri = uri
+        self.pages = Queue.Queue(max_pages)
+        self.stopped = threading.Event()
+    
+    def run(self):
+        uri = self.uri
         try:
-            Contact.objects.get(user=user, email=email)
-        except Contact.DoesNotExist:
-            Contact(user=user, name=name, email=email).save()
-            imported += 1
+            while not self.stopped.isSet():
+                if uri:
+                    feed = self.contacts_service.GetContactsFeed(uri=uri)
+                else:
+                    feed = self.contacts_service.GetContactsFeed()
+                next_link = feed.GetNextLink()
+                uri = next_link and next_link.href
+                self.put((feed.entry, uri, None))
+                if not uri:
+                    break
+        except Exception, e:
+            self.put(([], None, e))
+    
+    def put(self, page):
+        # wait for room in the queue, but give up once stopped so an
+        # abandoned import doesn't leave this thread blocked forever
+        while not self.stopped.isSet():
+            try:
+                self.pages.put(page, True, 0.5)
+                return
+            except Queue.Full:
+                pass
+    
+    def stop(self):
+        """
+        Stops fetching and discards any pages fetched but not consumed.
+        """
+        self.stopped.set()
+        while True:
+            try:
+                self.pages.get_nowait()
+            except Queue.Empty:
+                break
+    
+    def __iter__(self):
+        while True:
+            entries, next_href, error = self.pages.get()
+            if error is not None:
+                raise error
+            yield entries, next_href
+            if not next_href:
+                break
+
+
+@transaction.commit_on_success
+def _import_entries(importer, entries):
+    for entry in entries:
+        name = entry.title.text
+        for e in entry.email:
+            importer.add(name, e.address)
+    importer.flush()
+
+
+def iter_import_google(authsub_token, user, contacts_service=None, resume_from=None):
+    """
+    Uses the given AuthSub token to retrieve Google Contacts and import the
+    entries with an email address into the contacts of the given user.
+    
+    Pages are fetched in the background while earlier ones are imported,
+    each page being committed on its own. After each page this yields a
+    tuple of the running ImportResult and the href of the next page (None
+    after the last page); passing that href as ``resume_from`` continues an
+    interrupted import from there.
+    
+    ``contacts_service`` may be given in place of an AuthSub token.
+    """
     
-    return imported, total
+    if contacts_service is None:
+        contacts_service = gdata.contacts.service.ContactsService()
+        contacts_service.auth_token = authsub_token
+        contacts_service.UpgradeToSessionToken()
+    importer = ContactImporter(user)
+    fetcher = FeedPageFetcher(contacts_service, resume_from)
+    fetcher.start()
+    try:
+        for entries, next_href in fetcher:
+            _import_entries(importer, entries)
+            yield importer.result(), next_href
+    finally:
+        fetcher.stop()
 
 
-def import_google(authsub_token, user):
+@instrumented("import_google")
+def import_google(authsub_token, user, progress=None, checkpoint=None, contacts_service=None, resume_from=None):
     """
     Uses the given AuthSub token to retrieve Google Contacts and
     import the entries with an email address into the contacts of the
     given user.
     
-    Returns a tuple of (number imported, total number of entries).
-    """
-    
-    contacts_service = gdata.contacts.service.ContactsService()
-    contacts_service.auth_token = authsub_token
-    contacts_service.UpgradeToSessionToken()
-    entries = []
-    feed = contacts_service.GetContactsFeed()
-    entries.extend(feed.entry)
-    next_link = feed.GetNextLink()
-    while next_link:
-        feed = contacts_service.GetContactsFeed(uri=next_link.href)
-        entries.extend(feed.entry)
-        next_link = feed.GetNextLink()
-    total = 0
-    imported = 0
-    for entry in entries:
-        name = entry.title.text
-        for e in entry.email:
-            email = e.address
-            total += 1
-            try:
-                Contact.objects.get(user=user, email=email)
-            except Contact.DoesNotExist:
-                Contact(user=user, name=name, email=email).save()
-                imported += 1
-    return imported, total
+    If given, ``progress`` is called with the running ImportResult and
+    ``checkpoint`` with the href to resume from after each page is
+    committed (see iter_import_google).
+    
+    Returns an ImportResult tuple of (number imported, total number of entries).
+    """
+    
+    result = ImportResult(0, 0)
+    for result, next_href in iter_import_google(authsub_token, user, contacts_service, resume_from):
+        if progress is not None:
+            progress(result)
+        if checkpoint is not None:
+            checkpoint(next_href)
+    return result
+
+
+def queue_import_vcards(stream, user):
+    """
+    Queues an import of the given vcard stream to be run by the
+    process_import_jobs command, returning the ImportJob.
+    """
+    data = stream.read()
+    if isinstance(data, str):
+        data = data.decode("utf-8")
+    return ImportJob.objects.enqueue(user, "vcard", data)
+
+
+def queue_import_yahoo(bbauth_token, user):
+    """
+    Queues a Yahoo Address Book import (see import_yahoo) to be run by the
+    process_import_jobs command, returning the ImportJob.
+    """
+    return ImportJob.objects.enqueue(user, "yahoo", bbauth_token)
+
+
+def queue_import_google(authsub_token, user):
+    """
+    Queues a Google Contacts import (see import_google) to be run by the
+    process_import_jobs command, returning the ImportJob.
+    """
+    return ImportJob.objects.enqueue(user, "google", authsub_token)
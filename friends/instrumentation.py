@@ -0,0 +1,246 @@
+"""
+Opt-in timing of the public friends operations (friends_for_user,
+are_friends, invitation sending and accepting, the importers...).
+
+For each call this records the wall time, the number of database queries
+and the time spent in them, and passes them to every sink listed in
+FRIENDS_INSTRUMENTATION_SINKS:
+
+ * friends.instrumentation.LoggingSink logs each call to the
+   "friends.instrumentation" logger
+ * friends.instrumentation.HistogramSink keeps per-operation counts and
+   latency buckets in memory
+ * friends.instrumentation.StatsdSink passes timings to the callable named
+   by FRIENDS_STATSD_CALLBACK, called as ``callback(stat, milliseconds)``
+
+Nothing is measured unless a sink is configured (or added with add_sink),
+and only FRIENDS_INSTRUMENTATION_SAMPLE_RATE of calls are measured.
+Queries are counted whether or not DEBUG is on.
+"""
+
+import bisect
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends import BaseDatabaseWrapper
+from django.utils.functional import wraps
+from django.utils.importlib import import_module
+
+
+FRIENDS_INSTRUMENTATION_SINKS = getattr(settings, "FRIENDS_INSTRUMENTATION_SINKS", [])
+
+# fraction of calls measured, between 0 and 1
+FRIENDS_INSTRUMENTATION_SAMPLE_RATE = getattr(settings, "FRIENDS_INSTRUMENTATION_SAMPLE_RATE", 1.0)
+
+# dotted path of the callable StatsdSink sends timings to
+FRIENDS_STATSD_CALLBACK = getattr(settings, "FRIENDS_STATSD_CALLBACK", None)
+
+
+def load_object(path, kind):
+    module_name, name = path.rsplit(".", 1)
+    try:
+        return getattr(import_module(module_name), name)
+    except (ImportError, AttributeError), e:
+        raise ImproperlyConfigured("Error loading %s %s: %s" % (kind, path, e))
+
+
+class LoggingSink(object):
+    
+    def __init__(self, logger="friends.instrumentation", level=logging.DEBUG):
+        self.logger = logging.getLogger(logger)
+        self.level = level
+    
+    def record(self, name, seconds, queries, db_seconds):
+        self.logger.log(self.level, "%s: %.1fms, %d queries (%.1fms)" % (name, seconds * 1000, queries, db_seconds * 1000))
+
+
+class HistogramSink(object):
+    """
+    Counts calls per operation into fixed latency buckets (upper bounds in
+    milliseconds, the last one catching everything slower), along with
+    their total time, queries and database time.
+    """
+    
+    BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.operations = {}
+    
+    def record(self, name, seconds, queries, db_seconds):
+        bucket = bisect.bisect_left(self.BUCKETS, seconds * 1000)
+        self.lock.acquire()
+        try:
+            stats = self.operations.get(name)
+            if stats is None:
+                stats = self.operations[name] = {
+                    "calls": 0,
+                    "seconds": 0.0,
+                    "queries": 0,
+                    "db_seconds": 0.0,
+                    "max_queries": 0,
+                    "buckets": [0] * (len(self.BUCKETS) + 1),
+                }
+            stats["calls"] += 1
+            stats["seconds"] += seconds
+            stats["queries"] += queries
+            stats["db_seconds"] += db_seconds
+            stats["max_queries"] = max(stats["max_queries"], queries)
+            stats["buckets"][bucket] += 1
+        finally:
+            self.lock.release()
+    
+    def percentile(self, name, fraction):
+        """
+        Returns the upper bound in milliseconds of the bucket holding the
+        given fraction of calls to the operation (None for the last bucket
+        or an operation never recorded).
+        """
+        stats = self.operations.get(name)
+        if stats is None:
+            return None
+        needed = fraction * stats["calls"]
+        seen = 0
+        for bound, count in zip(self.BUCKETS, stats["buckets"]):
+            seen += count
+            if seen >= needed:
+                return bound
+        return None
+    
+    def snapshot(self):
+        self.lock.acquire()
+        try:
+            return dict([(name, dict(stats, buckets=list(stats["buckets"]))) for name, stats in self.operations.items()])
+        finally:
+            self.lock.release()
+    
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.operations = {}
+        finally:
+            self.lock.release()
+
+
+class StatsdSink(object):
+    
+    def __init__(self, callback=None, prefix="friends"):
+        if callback is None:
+            if FRIENDS_STATSD_CALLBACK is None:
+                raise ImproperlyConfigured("StatsdSink needs FRIENDS_STATSD_CALLBACK or a callback")
+            callback = load_object(FRIENDS_STATSD_CALLBACK, "statsd callback")
+        self.callback = callback
+        self.prefix = prefix
+    
+    def record(self, name, seconds, queries, db_seconds):
+        stat = "%s.%s" % (self.prefix, name)
+        self.callback(stat + ".time", seconds * 1000)
+        self.callback(stat + ".queries", queries)
+        self.callback(stat + ".db_time", db_seconds * 1000)
+
+
+class QueryTally(threading.local):
+    
+    def __init__(self):
+        # number of instrumented calls in progress in this thread
+        self.active = 0
+        self.queries = 0
+        self.db_seconds = 0.0
+
+_tally = QueryTally()
+
+
+class CountingCursor(object):
+    """
+    Wraps a cursor, adding each query and its time to the thread's tally.
+    """
+    
+    def __init__(self, cursor):
+        self.cursor = cursor
+    
+    def execute(self, sql, params=()):
+        start = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            _tally.queries += 1
+            _tally.db_seconds += time.time() - start
+    
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            _tally.queries += 1
+            _tally.db_seconds += time.time() - start
+    
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+    
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+_sinks = []
+_installed = False
+
+def _install():
+    """
+    Makes connections hand out counting cursors while an instrumented call
+    is in progress in the current thread.
+    """
+    global _installed
+    if _installed:
+        return
+    original = BaseDatabaseWrapper.cursor
+    def cursor(self):
+        cursor = original(self)
+        if _tally.active:
+            return CountingCursor(cursor)
+        return cursor
+    BaseDatabaseWrapper.cursor = cursor
+    _installed = True
+
+
+def add_sink(sink):
+    _install()
+    _sinks.append(sink)
+
+
+def remove_sink(sink):
+    _sinks.remove(sink)
+
+
+for path in FRIENDS_INSTRUMENTATION_SINKS:
+    add_sink(load_object(path, "instrumentation sink")())
+
+
+def instrumented(name):
+    """
+    Decorator measuring each call of the function as the given operation.
+    When no sinks are configured the only cost is an empty list check.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _sinks or (FRIENDS_INSTRUMENTATION_SAMPLE_RATE < 1 and random.random() >= FRIENDS_INSTRUMENTATION_SAMPLE_RATE):
+                return func(*args, **kwargs)
+            queries, db_seconds = _tally.queries, _tally.db_seconds
+            _tally.active += 1
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                seconds = time.time() - start
+                _tally.active -= 1
+                for sink in _sinks:
+                    try:
+                        sink.record(name, seconds, _tally.queries - queries, _tally.db_seconds - db_seconds)
+                    except Exception:
+                        logging.exception("friends: instrumentation sink %r failed" % sink)
+        return wrapper
+    return decorator
@@ -0,0 +1,16 @@
+from django.core.management.base import LabelCommand
+
+from friends.graph import FriendGraph
+
+
+class Command(LabelCommand):
+    help = "Builds a snapshot of the friendship graph for friends.graph and saves it to the given file."
+    args = "<path>"
+    label = "path"
+    
+    def handle_label(self, path, **options):
+        verbosity = int(options.get("verbosity", 1))
+        graph = FriendGraph.from_database()
+        graph.save(path)
+        if verbosity > 0:
+            print "Saved %d users and %d friendships to %s" % (len(graph.user_ids), len(graph.neighbours) // 2, path)
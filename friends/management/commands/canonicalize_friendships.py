@@ -0,0 +1,103 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+from django.db.models import F, Max, Min, Q
+
+from friends.models import Friendship, FriendStats, invalidate_friends_cache, invalidate_are_friends_cache
+from friends.utils import chunked
+
+
+# number of rows looked up or changed per query, keeping the parameters of
+# each well under SQLite's limit of 999 whatever the batch size
+QUERY_CHUNK_SIZE = 400
+
+
+class Command(NoArgsCommand):
+    help = "Rewrites friendships so from_user always holds the lower user id (see FRIENDS_CANONICAL_STORAGE)."
+    
+    option_list = NoArgsCommand.option_list + (
+        make_option("--batch-size", type="int", dest="batch_size", default=1000,
+            help="Number of friendship ids to examine per transaction."),
+        make_option("--sleep", type="float", dest="sleep", default=0,
+            help="Seconds to pause between batches."),
+    )
+    
+    def handle_noargs(self, **options):
+        batch_size = options["batch_size"]
+        verbosity = int(options.get("verbosity", 1))
+        bounds = Friendship.objects.aggregate(lowest=Min("id"), highest=Max("id"))
+        if bounds["lowest"] is None:
+            return
+        swapped = removed = 0
+        start = bounds["lowest"]
+        while start <= bounds["highest"]:
+            batch_swapped, batch_removed = canonicalize_batch(start, start + batch_size)
+            swapped += batch_swapped
+            removed += batch_removed
+            start += batch_size
+            if options["sleep"]:
+                time.sleep(options["sleep"])
+        if verbosity > 0:
+            print "Swapped %d friendships, removed %d duplicates" % (swapped, removed)
+
+
+@transaction.commit_on_success
+def canonicalize_batch(start, end):
+    """
+    Canonicalizes the friendships with ids in [start, end), returning a
+    tuple of (number swapped, number of duplicates removed).
+    """
+    reversed_rows = list(Friendship.objects.filter(
+        id__gte=start, id__lt=end, from_user__gt=F("to_user")
+    ).values_list("id", "from_user", "to_user"))
+    if not reversed_rows:
+        return 0, 0
+    
+    # a pair stored in both directions keeps its canonical row
+    canonical = set()
+    for rows in chunked(reversed_rows, QUERY_CHUNK_SIZE):
+        q = Q()
+        for friendship_id, from_user_id, to_user_id in rows:
+            q |= Q(from_user=to_user_id, to_user=from_user_id)
+        canonical.update(Friendship.objects.filter(q).values_list("from_user", "to_user"))
+    duplicate_ids = []
+    swap_ids = set()
+    for friendship_id, from_user_id, to_user_id in reversed_rows:
+        if (to_user_id, from_user_id) in canonical:
+            duplicate_ids.append(friendship_id)
+        else:
+            swap_ids.add(friendship_id)
+    
+    # raw SQL so removing duplicates doesn't cascade to their invitations
+    cursor = connection.cursor()
+    qn = connection.ops.quote_name
+    table = qn(Friendship._meta.db_table)
+    for ids in chunked(duplicate_ids, QUERY_CHUNK_SIZE):
+        cursor.execute("DELETE FROM %s WHERE id IN (%s)" % (
+            table, ", ".join(["%s"] * len(ids))
+        ), ids)
+    if swap_ids:
+        if "mysql" in connection.settings_dict["ENGINE"]:
+            # MySQL assigns SET columns left to right so can't swap in one go
+            for friendship_id, from_user_id, to_user_id in reversed_rows:
+                if friendship_id in swap_ids:
+                    Friendship.objects.filter(id=friendship_id).update(from_user=to_user_id, to_user=from_user_id)
+        else:
+            for ids in chunked(swap_ids, QUERY_CHUNK_SIZE):
+                cursor.execute("UPDATE %s SET %s = %s, %s = %s WHERE id IN (%s)" % (
+                    table,
+                    qn("from_user_id"), qn("to_user_id"),
+                    qn("to_user_id"), qn("from_user_id"),
+                    ", ".join(["%s"] * len(ids)),
+                ), ids)
+    transaction.set_dirty()
+    
+    for friendship_id, from_user_id, to_user_id in reversed_rows:
+        invalidate_friends_cache(from_user_id, to_user_id)
+        invalidate_are_friends_cache(from_user_id, to_user_id)
+        if friendship_id not in swap_ids:
+            FriendStats.objects.adjust(from_user_id, friends=-1)
+            FriendStats.objects.adjust(to_user_id, friends=-1)
+    return len(swap_ids), len(duplicate_ids)
@@ -0,0 +1,83 @@
+import datetime
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+from django.db.models import Max, Min
+
+from friends.models import FriendshipInvitation, FriendStats, JoinInvitation
+from friends.models import FRIENDS_INVITATION_EXPIRE_DAYS, PENDING_STATUSES
+from friends.models import adjust_pending_invitations, copy_to_history
+from friends.utils import chunked
+
+
+class Command(NoArgsCommand):
+    help = "Marks friendship and join invitations left unanswered for too long as expired."
+    
+    option_list = NoArgsCommand.option_list + (
+        make_option("--days", type="int", dest="days", default=FRIENDS_INVITATION_EXPIRE_DAYS,
+            help="Expire invitations sent more than this many days ago (default FRIENDS_INVITATION_EXPIRE_DAYS)."),
+        make_option("--batch-size", type="int", dest="batch_size", default=1000,
+            help="Number of invitation ids to examine per transaction."),
+        make_option("--sleep", type="float", dest="sleep", default=0,
+            help="Seconds to pause between batches."),
+        make_option("--history", action="store_true", dest="history", default=False,
+            help="Move expired friendship invitations into FriendshipInvitationHistory."),
+    )
+    
+    def handle_noargs(self, **options):
+        verbosity = int(options.get("verbosity", 1))
+        cutoff = datetime.date.today() - datetime.timedelta(days=options["days"])
+        for model, expire in [(FriendshipInvitation, expire_friendship_invitations), (JoinInvitation, expire_join_invitations)]:
+            expired = 0
+            bounds = model.objects.aggregate(lowest=Min("id"), highest=Max("id"))
+            start = bounds["lowest"]
+            while start is not None and start <= bounds["highest"]:
+                expired += expire(start, start + options["batch_size"], cutoff, options["history"])
+                start += options["batch_size"]
+                if options["sleep"]:
+                    time.sleep(options["sleep"])
+            if verbosity > 0:
+                print "Expired %d %s" % (expired, unicode(model._meta.verbose_name_plural))
+
+
+@transaction.commit_on_success
+def expire_friendship_invitations(start, end, cutoff, history):
+    """
+    Expires the pending friendship invitations with ids in [start, end)
+    sent before ``cutoff``, returning how many were expired.
+    """
+    expiring = FriendshipInvitation.objects.filter(id__gte=start, id__lt=end, sent__lt=cutoff, status__in=PENDING_STATUSES)
+    pairs = list(expiring.values_list("from_user", "to_user"))
+    if not pairs:
+        return 0
+    # the update repeats the conditions, so an invitation answered since it
+    # was read is left alone
+    expired = expiring.update(status="4")
+    if expired == len(pairs):
+        adjust_pending_invitations(pairs, -1)
+    else:
+        # some were answered in between; recount rather than guess which
+        for user_ids in chunked(set([user_id for pair in pairs for user_id in pair]), 400):
+            FriendStats.objects.rebuild(user_ids)
+    if history:
+        qn = connection.ops.quote_name
+        where = "%s >= %%s AND %s < %%s AND %s < %%s AND %s = %%s" % (qn("id"), qn("id"), qn("sent"), qn("status"))
+        params = [start, end, connection.ops.value_to_db_date(cutoff), "4"]
+        cursor = connection.cursor()
+        copy_to_history(cursor, where, params)
+        cursor.execute("DELETE FROM %s WHERE %s" % (qn(FriendshipInvitation._meta.db_table), where), params)
+        transaction.set_dirty()
+    return expired
+
+
+@transaction.commit_on_success
+def expire_join_invitations(start, end, cutoff, history):
+    """
+    Expires the pending join invitations with ids in [start, end) sent
+    before ``cutoff``, returning how many were expired.
+    """
+    return JoinInvitation.objects.filter(
+        id__gte=start, id__lt=end, sent__lt=cutoff, status__in=PENDING_STATUSES
+    ).update(status="4")
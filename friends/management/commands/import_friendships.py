@@ -0,0 +1,68 @@
+import csv
+import time
+from optparse import make_option
+
+from django.core.management.base import LabelCommand
+
+from django.contrib.auth.models import User
+
+from friends.models import Friendship, FRIENDS_BULK_BATCH_SIZE
+from friends.utils import chunked
+
+
+class Command(LabelCommand):
+    help = "Makes friends of the pairs of user ids (or usernames) in each row of the given CSV files."
+    args = "<path path ...>"
+    label = "path"
+    
+    option_list = LabelCommand.option_list + (
+        make_option("--usernames", action="store_true", dest="usernames", default=False,
+            help="The files hold usernames rather than user ids."),
+        make_option("--batch-size", type="int", dest="batch_size", default=FRIENDS_BULK_BATCH_SIZE,
+            help="Number of pairs created per transaction."),
+        make_option("--notify", action="store_true", dest="notify", default=False,
+            help="Send friends_otherconnect notifications for the new friendships."),
+        make_option("--sleep", type="float", dest="sleep", default=0,
+            help="Seconds to pause between batches."),
+    )
+    
+    def handle_label(self, path, **options):
+        verbosity = int(options.get("verbosity", 1))
+        f = open(path, "rb")
+        try:
+            read = created = skipped = 0
+            for rows in chunked(csv.reader(f), options["batch_size"]):
+                read += len(rows)
+                if options["usernames"]:
+                    pairs = username_pairs(rows)
+                else:
+                    pairs = id_pairs(rows)
+                skipped += len(rows) - len(pairs)
+                created += Friendship.objects.bulk_befriend(pairs, options["batch_size"], options["notify"])
+                if options["sleep"]:
+                    time.sleep(options["sleep"])
+        finally:
+            f.close()
+        if verbosity > 0:
+            print "%s: read %d pairs, made %d friendships, skipped %d unreadable or unknown" % (path, read, created, skipped)
+
+
+def id_pairs(rows):
+    pairs = []
+    for row in rows:
+        try:
+            pairs.append((int(row[0]), int(row[1])))
+        except (IndexError, ValueError):
+            continue # a header or malformed row
+    return pairs
+
+
+def username_pairs(rows):
+    rows = [row for row in rows if len(row) >= 2]
+    usernames = set([row[0] for row in rows] + [row[1] for row in rows])
+    user_ids = dict(User.objects.filter(username__in=usernames).values_list("username", "id"))
+    return [
+        (user_ids[row[0]], user_ids[row[1]])
+        for row in rows
+        if row[0] in user_ids and row[1] in user_ids
+    ]
@@ -0,0 +1,110 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+from django.db.models import Count, Max, Min
+
+from friends.models import Contact, FriendStats, JoinInvitation
+
+
+class Command(NoArgsCommand):
+    help = "Fills in Contact.normalized_email and merges each user's contacts that share a normalized email."
+    
+    option_list = NoArgsCommand.option_list + (
+        make_option("--batch-size", type="int", dest="batch_size", default=1000,
+            help="Number of contact ids (when filling in) or user ids (when merging) per transaction."),
+        make_option("--sleep", type="float", dest="sleep", default=0,
+            help="Seconds to pause between batches."),
+    )
+    
+    def handle_noargs(self, **options):
+        verbosity = int(options.get("verbosity", 1))
+        batch_size = options["batch_size"]
+        
+        filled = 0
+        bounds = Contact.objects.aggregate(lowest=Min("id"), highest=Max("id"))
+        start = bounds["lowest"]
+        while start is not None and start <= bounds["highest"]:
+            filled += fill_batch(start, start + batch_size)
+            start += batch_size
+            if options["sleep"]:
+                time.sleep(options["sleep"])
+        
+        merged = 0
+        bounds = Contact.objects.aggregate(lowest=Min("user"), highest=Max("user"))
+        start = bounds["lowest"]
+        while start is not None and start <= bounds["highest"]:
+            merged += merge_batch(start, start + batch_size)
+            start += batch_size
+            if options["sleep"]:
+                time.sleep(options["sleep"])
+        
+        if verbosity > 0:
+            print "Filled in %d normalized emails, merged away %d duplicate contacts" % (filled, merged)
+
+
+@transaction.commit_on_success
+def fill_batch(start, end):
+    """
+    Sets normalized_email for the contacts with ids in [start, end) that
+    don't have one yet, returning how many were set.
+    """
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    cursor.execute("UPDATE %(table)s SET %(normalized)s = LOWER(TRIM(%(email)s)) WHERE %(id)s >= %%s AND %(id)s < %%s AND %(normalized)s = ''" % {
+        "table": qn(Contact._meta.db_table),
+        "normalized": qn("normalized_email"),
+        "email": qn("email"),
+        "id": qn("id"),
+    }, [start, end])
+    transaction.set_dirty()
+    return cursor.rowcount
+
+
+@transaction.commit_on_success
+def merge_batch(start, end):
+    """
+    Merges the duplicate contacts of users with ids in [start, end) into
+    the oldest contact for each address, moving over their users and join
+    invitations. Returns the number of contacts removed.
+    """
+    groups = Contact.objects.filter(user__gte=start, user__lt=end).values("user", "normalized_email").annotate(
+        contacts=Count("id"), keep=Min("id")
+    ).filter(contacts__gt=1).order_by()
+    removed = 0
+    for group in groups:
+        duplicate_ids = list(Contact.objects.filter(
+            user=group["user"], normalized_email=group["normalized_email"]
+        ).exclude(id=group["keep"]).values_list("id", flat=True))
+        merge_contacts(group["keep"], duplicate_ids)
+        FriendStats.objects.adjust(group["user"], contacts=-len(duplicate_ids))
+        removed += len(duplicate_ids)
+    return removed
+
+
+def merge_contacts(keep_id, duplicate_ids):
+    qn = connection.ops.quote_name
+    users_field = Contact._meta.get_field("users")
+    names = {
+        "through": qn(users_field.m2m_db_table()),
+        "contact_id": qn(users_field.m2m_column_name()),
+        "user_id": qn(users_field.m2m_reverse_name()),
+        "contact": qn(Contact._meta.db_table),
+        "id": qn("id"),
+        "duplicates": ", ".join(["%s"] * len(duplicate_ids)),
+    }
+    cursor = connection.cursor()
+    # link the kept contact to every user its duplicates were linked to
+    cursor.execute("""
+        INSERT INTO %(through)s (%(contact_id)s, %(user_id)s)
+        SELECT DISTINCT %%s, t.%(user_id)s FROM %(through)s t
+        WHERE t.%(contact_id)s IN (%(duplicates)s) AND NOT EXISTS (
+            SELECT 1 FROM %(through)s k WHERE k.%(contact_id)s = %%s AND k.%(user_id)s = t.%(user_id)s
+        )
+    """ % names, [keep_id] + duplicate_ids + [keep_id])
+    JoinInvitation.objects.filter(contact__in=duplicate_ids).update(contact=keep_id)
+    # raw SQL so the duplicates' (already moved) invitations aren't cascaded
+    cursor.execute("DELETE FROM %(through)s WHERE %(contact_id)s IN (%(duplicates)s)" % names, duplicate_ids)
+    cursor.execute("DELETE FROM %(contact)s WHERE %(id)s IN (%(duplicates)s)" % names, duplicate_ids)
+    transaction.set_dirty()
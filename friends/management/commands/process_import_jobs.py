@@ -0,0 +1,42 @@
+import threading
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import connection
+
+from friends.models import ImportJob
+
+
+class Command(NoArgsCommand):
+    help = "Runs queued contact import jobs."
+    
+    option_list = NoArgsCommand.option_list + (
+        make_option("--workers", type="int", dest="workers", default=1,
+            help="Number of jobs to run at once."),
+        make_option("--poll", type="float", dest="poll", default=None,
+            help="Keep running, checking for new jobs every POLL seconds, rather than exiting once the queue is empty."),
+    )
+    
+    def handle_noargs(self, **options):
+        workers = []
+        for i in range(options["workers"]):
+            worker = threading.Thread(target=work, args=(options["poll"],))
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+
+
+def work(poll):
+    try:
+        while True:
+            job = ImportJob.objects.claim_next()
+            if job is None:
+                if poll is None:
+                    break
+                time.sleep(poll)
+                continue
+            job.run()
+    finally:
+        connection.close()
@@ -0,0 +1,66 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from django.contrib.auth.models import User
+
+from friends.models import FriendStats
+from friends.utils import chunked
+
+
+class Command(NoArgsCommand):
+    help = "Recounts the FriendStats of every user, or with --verify reports the users whose stored counts are wrong."
+    
+    option_list = NoArgsCommand.option_list + (
+        make_option("--verify", action="store_true", dest="verify", default=False,
+            help="Only report users whose counts are wrong, don't fix them."),
+        make_option("--batch-size", type="int", dest="batch_size", default=500,
+            help="Number of users to recount per transaction."),
+        make_option("--sleep", type="float", dest="sleep", default=0,
+            help="Seconds to pause between batches."),
+    )
+    
+    def handle_noargs(self, **options):
+        verbosity = int(options.get("verbosity", 1))
+        checked = wrong = 0
+        user_ids = User.objects.order_by("id").values_list("id", flat=True).iterator()
+        for batch in chunked(user_ids, options["batch_size"]):
+            checked += len(batch)
+            if options["verify"]:
+                for user_id in verify_batch(batch):
+                    wrong += 1
+                    if verbosity > 1:
+                        print "Counts for user %s are wrong" % user_id
+            else:
+                rebuild_batch(batch)
+            if options["sleep"]:
+                time.sleep(options["sleep"])
+        if verbosity > 0:
+            if options["verify"]:
+                print "Checked %d users, %d with wrong counts" % (checked, wrong)
+            else:
+                print "Recounted %d users" % checked
+
+
+def verify_batch(user_ids):
+    """
+    Returns the ids of the given users whose stored counts don't match the
+    actual ones.
+    """
+    counts = FriendStats.objects.compute(user_ids)
+    stored = {}
+    for stats in FriendStats.objects.filter(user__in=user_ids).values("user", "friends", "invitations_in", "invitations_out", "contacts"):
+        stored[stats.pop("user")] = stats
+    wrong = []
+    for user_id in user_ids:
+        # users without stats yet get them counted on first use
+        if stored.get(user_id, counts[user_id]) != counts[user_id]:
+            wrong.append(user_id)
+    return wrong
+
+
+@transaction.commit_on_success
+def rebuild_batch(user_ids):
+    FriendStats.objects.rebuild(user_ids)
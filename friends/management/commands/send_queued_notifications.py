@@ -0,0 +1,58 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+
+from friends.fanout import deliver
+from friends.models import QueuedNotification
+
+
+class Command(NoArgsCommand):
+    help = "Sends notification batches queued by friends.fanout.QueueExecutor."
+    
+    option_list = NoArgsCommand.option_list + (
+        make_option("--limit", type="int", dest="limit", default=None,
+            help="Maximum number of batches to send."),
+    )
+    
+    def handle_noargs(self, **options):
+        verbosity = int(options.get("verbosity", 1))
+        queued = QueuedNotification.objects.order_by("id").values_list("id", flat=True)
+        if options["limit"]:
+            queued = queued[:options["limit"]]
+        sent = skipped = 0
+        for queued_id in list(queued):
+            if send_batch(queued_id):
+                sent += 1
+            else:
+                skipped += 1
+        if verbosity > 0:
+            print "Sent %d notification batches, skipped %d" % (sent, skipped)
+
+
+@transaction.commit_on_success
+def send_batch(queued_id):
+    """
+    Claims, sends and removes a single queued batch, returning False if
+    another worker claimed it first or the invitation it refers to no
+    longer exists.
+    
+    The batch is claimed by deleting its row before anything is sent, so
+    of two workers draining the queue at once only the one whose DELETE
+    matched sends it; if sending fails the delete is rolled back and the
+    batch stays queued.
+    """
+    try:
+        queued = QueuedNotification.objects.select_related("to_user").get(id=queued_id)
+    except QueuedNotification.DoesNotExist:
+        return False # already sent by another worker
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM %s WHERE %s = %%s" % (qn(QueuedNotification._meta.db_table), qn("id")), [queued_id])
+    transaction.set_dirty()
+    if cursor.rowcount != 1:
+        return False # claimed by another worker since it was read
+    invitation = queued.invitation
+    if invitation is not None:
+        deliver(queued.label, queued.recipient_ids(), invitation, queued.to_user)
+    return invitation is not None
@@ -0,0 +1,18 @@
+from friends import request_cache
+
+
+class FriendshipCacheMiddleware(object):
+    """
+    Memoizes friendship lookups for the length of each request (see
+    friends.request_cache).
+    """
+    
+    def process_request(self, request):
+        # start afresh in case an earlier request on this thread never
+        # got as far as process_response
+        request_cache.discard()
+        request_cache.begin()
+    
+    def process_response(self, request, response):
+        request_cache.discard()
+        return response
@@ -1,22 +1,37 @@
+import bisect
 import datetime
+import re
+import traceback
+import uuid
 
-from random import random
+from array import array
+from StringIO import StringIO
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import connection, models, transaction, IntegrityError
+from django.db.models import Count, F, Q
 from django.db.models import signals
-from django.template.loader import render_to_string
+from django.template import Context
+from django.template.loader import get_template
+from django.utils.datastructures import SortedDict
 from django.utils.hashcompat import sha_constructor
 
 from django.contrib.sites.models import Site
 from django.contrib.auth.models import User
+from django.contrib.contenttypes import generic
+from django.contrib.contenttypes.models import ContentType
+
+from friends import request_cache
+from friends.instrumentation import instrumented
+from friends.utils import bulk_insert, chunked, in_bulk, normalize_email
 
 # favour django-mailer but fall back to django.core.mail
 if "mailer" in settings.INSTALLED_APPS:
-    from mailer import send_mail
+    from mailer import send_mass_mail
 else:
-    from django.core.mail import send_mail
+    from django.core.mail import send_mass_mail
 
 if "notification" in settings.INSTALLED_APPS:
     from notification import models as notification
@@ -29,6 +44,42 @@ else:
     EmailAddress = None
 
 
+# how long (in seconds) a user's friend list is kept in the cache
+FRIENDS_CACHE_TIMEOUT = getattr(settings, "FRIENDS_CACHE_TIMEOUT", 60 * 60)
+
+# number of friendship rows kept per cache entry, so the friend lists of users
+# with very many friends are split into entries under memcached's 1MB limit
+FRIENDS_CACHE_CHUNK_SIZE = getattr(settings, "FRIENDS_CACHE_CHUNK_SIZE", 5000)
+
+# age in days after which unanswered invitations are expired
+FRIENDS_INVITATION_EXPIRE_DAYS = getattr(settings, "FRIENDS_INVITATION_EXPIRE_DAYS", 30)
+
+# number of join invitations created and mailed together
+FRIENDS_INVITE_BATCH_SIZE = getattr(settings, "FRIENDS_INVITE_BATCH_SIZE", 100)
+
+# how many of a user's friends are considered when counting mutual friends
+# and suggesting friends of friends
+FRIENDS_MUTUAL_MAX_FRIENDS = getattr(settings, "FRIENDS_MUTUAL_MAX_FRIENDS", 400)
+
+# store each friendship with from_user holding the lower user id so a pair
+# can be found with a single index probe; existing rows must be converted
+# with the canonicalize_friendships command before turning this on
+FRIENDS_CANONICAL_STORAGE = getattr(settings, "FRIENDS_CANONICAL_STORAGE", False)
+
+# number of pairs bulk_befriend checks and inserts per transaction; the
+# check passes each user id twice, so keep it under 250 on SQLite
+FRIENDS_BULK_BATCH_SIZE = getattr(settings, "FRIENDS_BULK_BATCH_SIZE", 200)
+
+# number of friends loaded per query when hydrating a friend list or
+# iterating over a LazyFriendList
+FRIENDS_HYDRATE_BATCH_SIZE = getattr(settings, "FRIENDS_HYDRATE_BATCH_SIZE", 100)
+
+# minutes a running import job can go without recording progress before it
+# is assumed to have lost its worker and is handed to another one, resuming
+# from its checkpoint
+FRIENDS_IMPORT_STALE_MINUTES = getattr(settings, "FRIENDS_IMPORT_STALE_MINUTES", 60)
+
+
 class Contact(models.Model):
     """
     A contact is a person known by a user who may or may not themselves
@@ -40,38 +91,525 @@ class Contact(models.Model):
     
     name = models.CharField(max_length=100, null=True, blank=True)
     email = models.EmailField()
+    # lowercased and trimmed email, used for matching
+    normalized_email = models.CharField(max_length=75, db_index=True, editable=False)
     added = models.DateField(default=datetime.date.today)
     
     # the user(s) this contact correspond to
     users = models.ManyToManyField(User)
     
+    class Meta:
+        unique_together = (('user', 'normalized_email'),)
+    
+    def __init__(self, *args, **kwargs):
+        super(Contact, self).__init__(*args, **kwargs)
+        # set here rather than in save() so contacts inserted in bulk get it
+        if not self.normalized_email:
+            self.normalized_email = normalize_email(self.email)
+    
     def __unicode__(self):
         return "%s (%s's contact)" % (self.email, self.user)
+    
+    def save(self, *args, **kwargs):
+        self.normalized_email = normalize_email(self.email)
+        super(Contact, self).save(*args, **kwargs)
+
+
+def friends_cache_key(user_id):
+    return "friends:friend_list:%s" % user_id
+
+
+def are_friends_cache_key(user1_id, user2_id):
+    return "friends:are_friends:%s:%s" % (min(user1_id, user2_id), max(user1_id, user2_id))
+
+
+def get_cached_friendship_rows(user_id):
+    """
+    Returns the cached friendship rows of the given user, or None if they
+    aren't cached (or part of them has been evicted).
+    """
+    entry = cache.get(friends_cache_key(user_id))
+    if entry is None:
+        return None
+    version, chunks, rows = entry
+    if chunks > 1:
+        keys = ["%s:%s:%d" % (friends_cache_key(user_id), version, i) for i in range(1, chunks)]
+        cached = cache.get_many(keys)
+        if len(cached) < len(keys):
+            return None
+        rows = list(rows)
+        for key in keys:
+            rows.extend(cached[key])
+    return rows
+
+
+def cache_friendship_rows(user_id, rows):
+    """
+    Caches the friendship rows of the given user FRIENDS_CACHE_CHUNK_SIZE
+    rows per entry. The first chunk is kept with the number of chunks, so
+    most friend lists are a single entry; the rest are stored under keys
+    unique to this write so concurrent writes can't be mixed up.
+    """
+    chunks = list(chunked(rows, FRIENDS_CACHE_CHUNK_SIZE)) or [[]]
+    version = uuid.uuid4().hex
+    if len(chunks) > 1:
+        key = friends_cache_key(user_id)
+        cache.set_many(dict([
+            ("%s:%s:%d" % (key, version, i), chunks[i]) for i in range(1, len(chunks))
+        ]), FRIENDS_CACHE_TIMEOUT)
+    cache.set(friends_cache_key(user_id), (version, len(chunks), chunks[0]), FRIENDS_CACHE_TIMEOUT)
+
+
+def invalidate_friends_cache(*user_ids):
+    cache.delete_many([friends_cache_key(user_id) for user_id in user_ids])
+    request_cache.clear()
+
+
+def invalidate_are_friends_cache(user1_id, user2_id):
+    cache.delete(are_friends_cache_key(user1_id, user2_id))
+
+
+def _user_id(user):
+    # accept either User instances or bare ids
+    return getattr(user, "pk", user)
+
+
+def pair_q(user1_id, user2_id):
+    """
+    Returns a Q object matching the friendship between the two users.
+    """
+    if FRIENDS_CANONICAL_STORAGE:
+        return Q(from_user=min(user1_id, user2_id), to_user=max(user1_id, user2_id))
+    return Q(from_user=user1_id, to_user=user2_id) | Q(from_user=user2_id, to_user=user1_id)
+
+
+def friendship_invitations_q(from_user_id, to_user_id):
+    """
+    Returns a Q object matching the invitations that led to the friendship
+    from one user to the other.
+    """
+    if FRIENDS_CANONICAL_STORAGE:
+        # the invitation may have been sent in either direction
+        return Q(from_user=from_user_id, to_user=to_user_id) | Q(from_user=to_user_id, to_user=from_user_id)
+    return Q(from_user=from_user_id, to_user=to_user_id)
+
+
+class FriendEntry(object):
+    """
+    One of a user's friends along with the friendship connecting them.
+    
+    Item access (``entry["friend"]``) is supported so code written against
+    the dictionaries ``friends_for_user`` used to return keeps working.
+    """
+    
+    __slots__ = ("friend", "friendship")
+    
+    def __init__(self, friend, friendship):
+        self.friend = friend
+        self.friendship = friendship
+    
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+    
+    def __repr__(self):
+        return "<FriendEntry: %s>" % self.friend
+
+
+class FriendIdSet(object):
+    """
+    The ids of a user's friends, held as a sorted array of integers rather
+    than a set or User instances. Supports ``in``, ``len()`` and iteration.
+    """
+    
+    __slots__ = ("ids",)
+    
+    def __init__(self, ids):
+        self.ids = array("l", sorted(ids))
+    
+    def __contains__(self, user_id):
+        i = bisect.bisect_left(self.ids, user_id)
+        return i < len(self.ids) and self.ids[i] == user_id
+    
+    def __len__(self):
+        return len(self.ids)
+    
+    def __iter__(self):
+        return iter(self.ids)
+    
+    def __repr__(self):
+        return "<FriendIdSet: %d friends>" % len(self.ids)
+
+
+class LazyFriendList(object):
+    """
+    A user's friends as FriendEntry objects, holding only the friendship
+    rows until it is indexed, sliced or iterated, and then loading only
+    the friends asked for. Works with django.core.paginator.Paginator.
+    """
+    
+    def __init__(self, user, rows):
+        self.user = user
+        self.rows = rows
+    
+    def __len__(self):
+        return len(self.rows)
+    
+    def count(self):
+        return len(self.rows)
+    
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return Friendship.objects.hydrate(self.user, self.rows[k])
+        entries = Friendship.objects.hydrate(self.user, [self.rows[k]])
+        if not entries:
+            raise IndexError("friend no longer exists")
+        return entries[0]
+    
+    def __iter__(self):
+        for rows in chunked(self.rows, FRIENDS_HYDRATE_BATCH_SIZE):
+            for entry in Friendship.objects.hydrate(self.user, rows):
+                yield entry
 
 
 class FriendshipManager(models.Manager):
     
+    def friendship_rows(self, user):
+        """
+        Returns a list of ``(friendship_id, from_user_id, to_user_id, added)``
+        tuples for every friendship the given user is part of.
+        
+        The rows are fetched with a single query and kept in the cache
+        until one of the user's friendships is saved or deleted.
+        """
+        user_id = _user_id(user)
+        def fetch():
+            rows = get_cached_friendship_rows(user_id)
+            if rows is None:
+                rows = list(self.filter(Q(from_user=user_id) | Q(to_user=user_id)).values_list("id", "from_user", "to_user", "added"))
+                cache_friendship_rows(user_id, rows)
+            return rows
+        return request_cache.get(("friendship_rows", user_id), fetch)
+    
+    @instrumented("friends_for_user")
     def friends_for_user(self, user):
+        # copied so callers can't change the memoized list
+        return list(request_cache.get(("friends_for_user", user.pk), lambda: self._friends_for_user(user)))
+    
+    def _friends_for_user(self, user):
+        return self.hydrate(user, self.friendship_rows(user))
+    
+    def lazy_friends_for_user(self, user):
+        """
+        Returns a LazyFriendList of the given user's friends, which only
+        loads the friends in the slices taken from it.
+        """
+        return LazyFriendList(user, self.friendship_rows(user))
+    
+    def hydrate(self, user, rows):
+        """
+        Returns a FriendEntry for each of the given friendship rows of the
+        user (see ``friendship_rows``), loading the friends
+        FRIENDS_HYDRATE_BATCH_SIZE per query.
+        """
+        friend_ids = []
+        for friendship_id, from_user_id, to_user_id, added in rows:
+            if from_user_id == user.pk:
+                friend_ids.append(to_user_id)
+            else:
+                friend_ids.append(from_user_id)
+        users = in_bulk(User, friend_ids, FRIENDS_HYDRATE_BATCH_SIZE)
         friends = []
-        for friendship in self.filter(from_user=user).select_related(depth=1):
-            friends.append({"friend": friendship.to_user, "friendship": friendship})
-        for friendship in self.filter(to_user=user).select_related(depth=1):
-            friends.append({"friend": friendship.from_user, "friendship": friendship})
+        for (friendship_id, from_user_id, to_user_id, added), friend_id in zip(rows, friend_ids):
+            friend = users.get(friend_id)
+            if friend is None:
+                continue # user deleted since the rows were cached
+            if from_user_id == user.pk:
+                friendship = Friendship(id=friendship_id, from_user=user, to_user=friend, added=added)
+            else:
+                friendship = Friendship(id=friendship_id, from_user=friend, to_user=user, added=added)
+            friends.append(FriendEntry(friend, friendship))
         return friends
     
+    def _friend_ids(self, user):
+        user_id = _user_id(user)
+        friend_ids = []
+        for friendship_id, from_user_id, to_user_id, added in self.friendship_rows(user_id):
+            if from_user_id == user_id:
+                friend_ids.append(to_user_id)
+            else:
+                friend_ids.append(from_user_id)
+        return friend_ids
+    
+    @instrumented("are_friends")
     def are_friends(self, user1, user2):
-        if self.filter(from_user=user1, to_user=user2).count() > 0:
-            return True
-        if self.filter(from_user=user2, to_user=user1).count() > 0:
-            return True
-        return False
+        user1_id, user2_id = _user_id(user1), _user_id(user2)
+        if request_cache.active():
+            # load the friends of whichever user has come up more often in
+            # this request, so checking one user against many costs a
+            # single query
+            seen = request_cache.get("are_friends_users", dict)
+            seen[user1_id] = seen.get(user1_id, 0) + 1
+            seen[user2_id] = seen.get(user2_id, 0) + 1
+            if seen[user2_id] > seen[user1_id]:
+                user1_id, user2_id = user2_id, user1_id
+            return user2_id in friend_ids_for(user1_id)
+        rows = get_cached_friendship_rows(user1_id)
+        if rows is not None:
+            for friendship_id, from_user_id, to_user_id, added in rows:
+                if user2_id in (from_user_id, to_user_id):
+                    return True
+            return False
+        key = are_friends_cache_key(user1_id, user2_id)
+        friends = cache.get(key)
+        if friends is None:
+            friends = self.filter(pair_q(user1_id, user2_id)).exists()
+            cache.set(key, friends, FRIENDS_CACHE_TIMEOUT)
+        return friends
+    
+    def friends_among(self, user, candidates):
+        """
+        Returns the set of ids of those users in ``candidates`` (User
+        instances or ids) who are friends with ``user``, using one query.
+        """
+        user_id = _user_id(user)
+        candidate_ids = set([_user_id(candidate) for candidate in candidates])
+        if not candidate_ids:
+            return set()
+        rows = get_cached_friendship_rows(user_id)
+        if rows is None:
+            rows = self.filter(
+                Q(from_user=user_id, to_user__in=candidate_ids) | Q(to_user=user_id, from_user__in=candidate_ids)
+            ).values_list("id", "from_user", "to_user", "added")
+        friend_ids = set()
+        for friendship_id, from_user_id, to_user_id, added in rows:
+            if from_user_id == user_id:
+                friend_ids.add(to_user_id)
+            else:
+                friend_ids.add(from_user_id)
+        return friend_ids & candidate_ids
+    
+    def friendship_matrix(self, pairs, chunk_size=200):
+        """
+        Returns a dictionary mapping each ``(user1, user2)`` pair (of User
+        instances or ids) to whether the two users are friends.
+        
+        Pairs are resolved with one query per ``chunk_size`` pairs.
+        """
+        pairs = list(pairs)
+        result = dict([(pair, False) for pair in pairs])
+        found = set()
+        for start in range(0, len(pairs), chunk_size):
+            q = Q()
+            for user1, user2 in pairs[start:start + chunk_size]:
+                q |= pair_q(_user_id(user1), _user_id(user2))
+            for from_user_id, to_user_id in self.filter(q).values_list("from_user", "to_user"):
+                found.add((from_user_id, to_user_id))
+                found.add((to_user_id, from_user_id))
+        for user1, user2 in pairs:
+            result[(user1, user2)] = (_user_id(user1), _user_id(user2)) in found
+        return result
+    
+    def mutual_friends(self, user1, user2, offset=0, limit=None):
+        """
+        Returns the users who are friends of both the given users, ordered
+        by id and sliced by ``offset`` and ``limit``.
+        
+        The mutual friends are found by joining the two users' friendships
+        in the database, so no list of friend ids is passed in the query.
+        """
+        edges_sql = self._edges_sql(1)
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT DISTINCT edges1.friend_id FROM (%s) edges1
+            INNER JOIN (%s) edges2 ON edges1.friend_id = edges2.friend_id
+        """ % (edges_sql, edges_sql), [_user_id(user1)] * 2 + [_user_id(user2)] * 2)
+        mutual_ids = sorted([row[0] for row in cursor.fetchall()])
+        if limit is not None:
+            mutual_ids = mutual_ids[offset:offset + limit]
+        else:
+            mutual_ids = mutual_ids[offset:]
+        users = in_bulk(User, mutual_ids, FRIENDS_HYDRATE_BATCH_SIZE)
+        return [users[user_id] for user_id in mutual_ids if user_id in users]
+    
+    def mutual_friend_counts(self, user, candidates, chunk_size=200):
+        """
+        Returns a dictionary mapping the id of each of the given candidate
+        users (User instances or ids) to the number of friends they have in
+        common with ``user``, computed with one query per ``chunk_size``
+        candidates.
+        
+        Only the first FRIENDS_MUTUAL_MAX_FRIENDS of the user's friends are
+        considered.
+        """
+        candidate_ids = list(set([_user_id(candidate) for candidate in candidates]))
+        counts = dict([(candidate_id, 0) for candidate_id in candidate_ids])
+        friend_ids = self._friend_ids(user)[:FRIENDS_MUTUAL_MAX_FRIENDS]
+        if not candidate_ids or not friend_ids:
+            return counts
+        cursor = connection.cursor()
+        for chunk in chunked(candidate_ids, chunk_size):
+            cursor.execute("""
+                SELECT edges.user_id, COUNT(*) FROM (%s) edges
+                WHERE edges.friend_id IN (%s)
+                GROUP BY edges.user_id
+            """ % (self._edges_sql(len(chunk)), ", ".join(["%s"] * len(friend_ids))),
+                chunk + chunk + friend_ids)
+            for candidate_id, count in cursor.fetchall():
+                counts[candidate_id] = count
+        return counts
+    
+    def suggested_friends(self, user, offset=0, limit=20):
+        """
+        Returns ``(user, mutual friend count)`` tuples for people who are
+        friends of the given user's friends but not friends of the user,
+        most mutual friends first.
+        
+        Only the first FRIENDS_MUTUAL_MAX_FRIENDS of the user's friends are
+        expanded, which bounds the work done for users with very many
+        friends.
+        """
+        user_id = _user_id(user)
+        friend_ids = self._friend_ids(user_id)[:FRIENDS_MUTUAL_MAX_FRIENDS]
+        if not friend_ids:
+            return []
+        qn = connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT edges.friend_id, COUNT(*) AS mutual FROM (%s) edges
+            WHERE edges.friend_id <> %%s AND edges.friend_id NOT IN (
+                SELECT %s FROM %s WHERE %s = %%s
+                UNION
+                SELECT %s FROM %s WHERE %s = %%s
+            )
+            GROUP BY edges.friend_id
+            ORDER BY mutual DESC, edges.friend_id
+            LIMIT %d OFFSET %d
+        """ % (
+            self._edges_sql(len(friend_ids)),
+            qn("to_user_id"), table, qn("from_user_id"),
+            qn("from_user_id"), table, qn("to_user_id"),
+            int(limit), int(offset),
+        ), friend_ids + friend_ids + [user_id, user_id, user_id])
+        rows = cursor.fetchall()
+        users = User.objects.in_bulk([row[0] for row in rows])
+        return [(users[suggested_id], mutual) for suggested_id, mutual in rows if suggested_id in users]
+    
+    def _edges_sql(self, count):
+        """
+        Returns SQL selecting ``(user_id, friend_id)`` for every friendship
+        of ``count`` users whose ids are passed as parameters twice over.
+        """
+        qn = connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        placeholders = ", ".join(["%s"] * count)
+        return """
+            SELECT %(from)s AS user_id, %(to)s AS friend_id FROM %(table)s WHERE %(from)s IN (%(ids)s)
+            UNION ALL
+            SELECT %(to)s, %(from)s FROM %(table)s WHERE %(to)s IN (%(ids)s)
+        """ % {"from": qn("from_user_id"), "to": qn("to_user_id"), "table": table, "ids": placeholders}
     
     def remove(self, user1, user2):
-        if self.filter(from_user=user1, to_user=user2):
-            friendship = self.filter(from_user=user1, to_user=user2)
-        elif self.filter(from_user=user2, to_user=user1):
-            friendship = self.filter(from_user=user2, to_user=user1)
-        friendship.delete()
+        self.filter(pair_q(_user_id(user1), _user_id(user2))).delete()
+    
+    @transaction.commit_on_success
+    def remove_many(self, pairs, chunk_size=100):
+        """
+        Removes the friendships between each of the given ``(user1, user2)``
+        pairs (of User instances or ids), marking their invitations deleted
+        as ``remove`` does.
+        
+        Friendships are found and deleted ``chunk_size`` pairs at a time, all
+        in one transaction. Returns the number of friendships removed.
+        """
+        removed = 0
+        for chunk in chunked(pairs, chunk_size):
+            q = Q()
+            for user1, user2 in chunk:
+                q |= pair_q(_user_id(user1), _user_id(user2))
+            # a pair stored both ways round has two rows
+            for rows in chunked(list(self.filter(q).values_list("id", "from_user", "to_user")), chunk_size):
+                self._remove_rows(rows)
+                removed += len(rows)
+        return removed
+    
+    def _remove_rows(self, rows):
+        invitations_q = Q()
+        for friendship_id, from_user_id, to_user_id in rows:
+            invitations_q |= friendship_invitations_q(from_user_id, to_user_id)
+        delete_invitations(invitations_q)
+        qn = connection.ops.quote_name
+        ids = [row[0] for row in rows]
+        # raw SQL as a queryset delete would send pre_delete for each row
+        connection.cursor().execute("DELETE FROM %s WHERE %s IN (%s)" % (
+            qn(self.model._meta.db_table), qn("id"), ", ".join(["%s"] * len(ids))
+        ), ids)
+        transaction.set_dirty()
+        for friendship_id, from_user_id, to_user_id in rows:
+            invalidate_friends_cache(from_user_id, to_user_id)
+            invalidate_are_friends_cache(from_user_id, to_user_id)
+            FriendStats.objects.adjust(from_user_id, friends=-1)
+            FriendStats.objects.adjust(to_user_id, friends=-1)
+    
+    def bulk_befriend(self, pairs, batch_size=FRIENDS_BULK_BATCH_SIZE, notify=False):
+        """
+        Makes each of the given ``(user1, user2)`` pairs (of User instances or
+        ids) friends, returning the number of friendships created.
+        
+        Pairs are taken ``batch_size`` at a time, each batch in its own
+        transaction: repeats (either way round) and pairs already friends
+        are skipped, found with one query, and the rest inserted in bulk
+        without sending signals. Unless ``notify`` is given no
+        notifications are sent; if it is, friends_otherconnect goes out
+        through the fan-out executor after each batch is committed.
+        """
+        created = 0
+        for chunk in chunked(pairs, batch_size):
+            keys = self._befriend_batch(chunk)
+            created += len(keys)
+            if notify and keys:
+                from friends.fanout import notify_connection
+                user_ids = set([user_id for key in keys for user_id in key])
+                friendships = self.filter(from_user__in=user_ids, to_user__in=user_ids).select_related("from_user", "to_user")
+                for friendship in friendships:
+                    if (min(friendship.from_user_id, friendship.to_user_id), max(friendship.from_user_id, friendship.to_user_id)) in keys:
+                        notify_connection(friendship, friendship.from_user, friendship.to_user, to_user=friendship.to_user)
+        return created
+    
+    @transaction.commit_on_success
+    def _befriend_batch(self, pairs):
+        """
+        Creates the friendships for one batch of bulk_befriend, returning the
+        set of ``(lower id, higher id)`` pairs created.
+        """
+        keys = set()
+        for user1, user2 in pairs:
+            user1_id, user2_id = _user_id(user1), _user_id(user2)
+            if user1_id != user2_id:
+                keys.add((min(user1_id, user2_id), max(user1_id, user2_id)))
+        if not keys:
+            return keys
+        user_ids = set([user_id for key in keys for user_id in key])
+        for from_user_id, to_user_id in self.filter(from_user__in=user_ids, to_user__in=user_ids).values_list("from_user", "to_user"):
+            keys.discard((min(from_user_id, to_user_id), max(from_user_id, to_user_id)))
+        if not keys:
+            return keys
+        today = datetime.date.today()
+        # the lower id goes in from_user, as with FRIENDS_CANONICAL_STORAGE
+        bulk_insert(self.model, [
+            self.model(from_user_id=lower_id, to_user_id=higher_id, added=today)
+            for lower_id, higher_id in keys
+        ], len(keys))
+        deltas = {}
+        for key in keys:
+            for user_id in key:
+                deltas[user_id] = deltas.get(user_id, 0) + 1
+        FriendStats.objects.adjust_many("friends", deltas)
+        invalidate_friends_cache(*deltas.keys())
+        cache.delete_many([are_friends_cache_key(lower_id, higher_id) for lower_id, higher_id in keys])
+        return keys
 
 
 class Friendship(models.Model):
@@ -89,10 +627,15 @@ class Friendship(models.Model):
     
     class Meta:
         unique_together = (('to_user', 'from_user'),)
+    
+    def save(self, *args, **kwargs):
+        if FRIENDS_CANONICAL_STORAGE and self.from_user_id > self.to_user_id:
+            self.from_user, self.to_user = self.to_user, self.from_user
+        super(Friendship, self).save(*args, **kwargs)
 
 
 def friend_set_for(user):
-    return set([obj["friend"] for obj in Friendship.objects.friends_for_user(user)])
+    return set([obj.friend for obj in Friendship.objects.friends_for_user(user)])
 
 
 INVITE_STATUS = (
@@ -106,32 +649,159 @@ INVITE_STATUS = (
     ("8", "Deleted")
 )
 
+def friend_ids_for(user):
+    """
+    Returns a FriendIdSet of the ids of the given user's friends, for
+    membership tests without loading any User rows.
+    """
+    return request_cache.get(("friend_id_set", _user_id(user)), lambda: FriendIdSet(Friendship.objects._friend_ids(user)))
+
+
+# invitations still waiting on an answer
+PENDING_STATUSES = ["1", "2"]
+
+# invitations which are over (expired, declined or deleted) and so don't
+# stop the same users inviting each other again
+CLOSED_STATUSES = ["4", "6", "8"]
+
+
+CONFIRMATION_KEY_RE = re.compile(r"^[0-9a-f]{40}$")
+
 
 class JoinInvitationManager(models.Manager):
     
+    @instrumented("send_invitation")
     def send_invitation(self, from_user, to_email, message):
-        contact, created = Contact.objects.get_or_create(email=to_email, user=from_user)
-        salt = sha_constructor(str(random())).hexdigest()[:5]
-        confirmation_key = sha_constructor(salt + to_email).hexdigest()
-        
-        accept_url = u"http://%s%s" % (
-            unicode(Site.objects.get_current()),
-            reverse("friends_accept_join", args=(confirmation_key,)),
+        contact, created = Contact.objects.get_or_create(
+            user=from_user,
+            normalized_email=normalize_email(to_email),
+            defaults={"email": to_email.strip()},
         )
+        confirmation_key = self._confirmation_key(to_email)
+        send_mass_mail([self._render_mail(from_user, to_email, message, confirmation_key)])
+        return self.create(from_user=from_user, contact=contact, message=message, status="2", confirmation_key=confirmation_key)
+    
+    @instrumented("send_invitations")
+    def send_invitations(self, from_user, emails, message):
+        """
+        Invites each of the given email addresses to join the site, creating
+        contacts for the addresses the user doesn't have yet.
         
-        ctx = {
+        Invitations are created and mailed FRIENDS_INVITE_BATCH_SIZE at a
+        time, each batch with a handful of queries and a single mail
+        connection. Returns the invitations in the order of ``emails``.
+        """
+        unique_emails = []
+        seen = set()
+        for email in emails:
+            if normalize_email(email) not in seen:
+                seen.add(normalize_email(email))
+                unique_emails.append(email.strip())
+        templates = self._templates()
+        site = unicode(Site.objects.get_current())
+        invitations = []
+        for batch in chunked(unique_emails, FRIENDS_INVITE_BATCH_SIZE):
+            invitations.extend(self._send_batch(from_user, batch, message, templates, site))
+        return invitations
+    
+    def _templates(self):
+        return (
+            get_template("friends/join_invite_subject.txt"),
+            get_template("friends/join_invite_message.txt"),
+        )
+    
+    def _render_mail(self, from_user, to_email, message, confirmation_key, templates=None, site=None):
+        if templates is None:
+            templates = self._templates()
+        if site is None:
+            site = unicode(Site.objects.get_current())
+        subject_template, message_template = templates
+        ctx = Context({
             "SITE_NAME": settings.SITE_NAME,
             "CONTACT_EMAIL": settings.CONTACT_EMAIL,
             "user": from_user,
             "message": message,
-            "accept_url": accept_url,
-        }
-        
-        subject = render_to_string("friends/join_invite_subject.txt", ctx)
-        email_message = render_to_string("friends/join_invite_message.txt", ctx)
+            "accept_url": u"http://%s%s" % (site, reverse("friends_accept_join", args=(confirmation_key,))),
+        })
+        return (subject_template.render(ctx), message_template.render(ctx), settings.DEFAULT_FROM_EMAIL, [to_email])
+    
+    @transaction.commit_on_success
+    def _send_batch(self, from_user, emails, message, templates, site):
+        contacts = self._contacts_for(from_user, emails)
+        invitations = []
+        mails = []
+        for email in emails:
+            confirmation_key = self._confirmation_key(email)
+            mails.append(self._render_mail(from_user, email, message, confirmation_key, templates, site))
+            invitations.append(JoinInvitation(
+                from_user=from_user,
+                contact=contacts[normalize_email(email)],
+                message=message,
+                status="2",
+                confirmation_key=confirmation_key,
+            ))
+        bulk_insert(JoinInvitation, invitations)
+        created = self.in_bulk_by_key([invitation.confirmation_key for invitation in invitations])
+        # mail last, so a failure to write the batch sends nothing and a
+        # failure to send it rolls the batch back
+        send_mass_mail(mails)
+        return [created[invitation.confirmation_key] for invitation in invitations]
+    
+    def _contacts_for(self, user, emails):
+        """
+        Returns a dictionary mapping the normalized form of each email
+        address to the user's contact for it, creating missing contacts.
+        """
+        def fetch():
+            contacts = {}
+            normalized = [normalize_email(email) for email in emails]
+            for contact in Contact.objects.filter(user=user, normalized_email__in=normalized):
+                contacts[contact.normalized_email] = contact
+            return contacts
+        contacts = fetch()
+        missing = [email for email in emails if normalize_email(email) not in contacts]
+        if missing:
+            bulk_insert(Contact, [Contact(user=user, email=email) for email in missing])
+            FriendStats.objects.adjust(user.pk, contacts=len(missing))
+            contacts = fetch()
+        return contacts
+    
+    def _confirmation_key(self, email):
+        # uuid4 gives 122 random bits, so keys don't collide in practice and
+        # the unique index on confirmation_key catches it if one ever does
+        return sha_constructor(uuid.uuid4().hex + email.encode("utf-8")).hexdigest()
+    
+    def get_for_key(self, confirmation_key):
+        """
+        Returns the pending, unexpired invitation with the given confirmation
+        key, or None if there isn't one.
         
-        send_mail(subject, email_message, settings.DEFAULT_FROM_EMAIL, [to_email])        
-        return self.create(from_user=from_user, contact=contact, message=message, status="2", confirmation_key=confirmation_key)
+        Keys that don't match are remembered in the cache so that repeated
+        probing with made-up keys doesn't reach the database.
+        """
+        if not CONFIRMATION_KEY_RE.match(confirmation_key):
+            return None
+        cache_key = "friends:missing_join_key:%s" % confirmation_key
+        if cache.get(cache_key):
+            return None
+        cutoff = datetime.date.today() - datetime.timedelta(days=FRIENDS_INVITATION_EXPIRE_DAYS)
+        try:
+            return self.select_related("from_user", "contact").get(
+                confirmation_key=confirmation_key,
+                status__in=PENDING_STATUSES,
+                sent__gte=cutoff,
+            )
+        except self.model.DoesNotExist:
+            cache.set(cache_key, True, FRIENDS_CACHE_TIMEOUT)
+            return None
+    
+    def in_bulk_by_key(self, confirmation_keys):
+        """
+        Returns a dictionary mapping each of the given confirmation keys to
+        its invitation.
+        """
+        invitations = self.filter(confirmation_key__in=confirmation_keys).select_related("from_user", "contact")
+        return dict([(invitation.confirmation_key, invitation) for invitation in invitations])
 
 
 class JoinInvitation(models.Model):
@@ -145,10 +815,11 @@ class JoinInvitation(models.Model):
     message = models.TextField()
     sent = models.DateField(default=datetime.date.today)
     status = models.CharField(max_length=1, choices=INVITE_STATUS)
-    confirmation_key = models.CharField(max_length=40)
+    confirmation_key = models.CharField(max_length=40, unique=True)
     
     objects = JoinInvitationManager()
     
+    @instrumented("join_invitation.accept")
     def accept(self, new_user):
         # mark invitation accepted
         self.status = "5"
@@ -158,18 +829,97 @@ class JoinInvitation(models.Model):
         friendship.save()
         # notify
         if notification:
+            from friends.fanout import notify_connection
             notification.send([self.from_user], "join_accept", {"invitation": self, "new_user": new_user})
-            friends = []
-            for user in friend_set_for(new_user) | friend_set_for(self.from_user):
-                if user != new_user and user != self.from_user:
-                    friends.append(user)
-            notification.send(friends, "friends_otherconnect", {"invitation": self, "to_user": new_user})
+            notify_connection(self, new_user, self.from_user, to_user=new_user)
 
 
 class FriendshipInvitationManager(models.Manager):
     
     def invitations(self, *args, **kwargs):
-        return self.filter(*args, **kwargs).exclude(status__in=["6", "8"])
+        return self.filter(*args, **kwargs).exclude(status__in=CLOSED_STATUSES)
+    
+    def incoming(self, user, before=None, limit=20):
+        """
+        Returns up to ``limit`` pending invitations to the given user, newest
+        first. Pass the last invitation of a page as ``before`` to get the
+        next page.
+        """
+        return self._page(self.filter(to_user=user, status__in=PENDING_STATUSES), before, limit)
+    
+    def outgoing(self, user, before=None, limit=20):
+        """
+        Returns up to ``limit`` pending invitations from the given user,
+        newest first, paged like ``incoming``.
+        """
+        return self._page(self.filter(from_user=user, status__in=PENDING_STATUSES), before, limit)
+    
+    def with_invite_state(self, from_user, users):
+        """
+        Returns the given User queryset with each user marked as to whether
+        ``from_user`` has already invited them (``invited``), they have
+        invited ``from_user`` (``invited_by``) or the two are already
+        friends (``is_friend``), all worked out in the same query.
+        """
+        qn = connection.ops.quote_name
+        names = {
+            "invitation": qn(self.model._meta.db_table),
+            "friendship": qn(Friendship._meta.db_table),
+            "user_id": "%s.%s" % (qn(User._meta.db_table), qn("id")),
+            "from_user_id": qn("from_user_id"),
+            "to_user_id": qn("to_user_id"),
+            "status": qn("status"),
+            "closed": ", ".join(["%s"] * len(CLOSED_STATUSES)),
+        }
+        select = SortedDict([
+            ("invited", "EXISTS (SELECT 1 FROM %(invitation)s WHERE %(from_user_id)s = %%s AND %(to_user_id)s = %(user_id)s AND %(status)s NOT IN (%(closed)s))" % names),
+            ("invited_by", "EXISTS (SELECT 1 FROM %(invitation)s WHERE %(from_user_id)s = %(user_id)s AND %(to_user_id)s = %%s AND %(status)s NOT IN (%(closed)s))" % names),
+            ("is_friend", "EXISTS (SELECT 1 FROM %(friendship)s WHERE (%(from_user_id)s = %%s AND %(to_user_id)s = %(user_id)s) OR (%(from_user_id)s = %(user_id)s AND %(to_user_id)s = %%s))" % names),
+        ])
+        user_id = _user_id(from_user)
+        return users.extra(select=select, select_params=[user_id] + CLOSED_STATUSES + [user_id] + CLOSED_STATUSES + [user_id, user_id])
+    
+    @instrumented("invite_many")
+    @transaction.commit_on_success
+    def invite_many(self, from_user, to_users, message=""):
+        """
+        Invites those of the given users (or user ids) who haven't already
+        invited, been invited by or befriended ``from_user``, returning the
+        new invitations. The checks take one query and the invitations are
+        inserted in bulk.
+        """
+        to_users = User.objects.filter(pk__in=[_user_id(user) for user in to_users]).exclude(pk=from_user.pk)
+        to_users = [user for user in self.with_invite_state(from_user, to_users) if not (user.invited or user.invited_by or user.is_friend)]
+        if not to_users:
+            return []
+        to_user_ids = [user.pk for user in to_users]
+        # earlier invitations left are closed ones (CLOSED_STATUSES), which
+        # aren't pending, so moving them to the history leaves the counts alone
+        qn = connection.ops.quote_name
+        where = "%s = %%s AND %s IN (%s)" % (qn("from_user_id"), qn("to_user_id"), ", ".join(["%s"] * len(to_user_ids)))
+        cursor = connection.cursor()
+        if copy_to_history(cursor, where, [from_user.pk] + to_user_ids):
+            cursor.execute("DELETE FROM %s WHERE %s" % (qn(self.model._meta.db_table), where), [from_user.pk] + to_user_ids)
+        transaction.set_dirty()
+        bulk_insert(self.model, [
+            self.model(from_user=from_user, to_user=user, message=message, status="2")
+            for user in to_users
+        ])
+        adjust_pending_invitations([(from_user.pk, user_id) for user_id in to_user_ids], 1)
+        invitations = list(self.filter(from_user=from_user, to_user__in=to_user_ids).select_related("to_user"))
+        if notification:
+            for invitation in invitations:
+                invitation.from_user = from_user
+                notification.send([invitation.to_user], "friends_invite", {"invitation": invitation})
+                notification.send([from_user], "friends_invite_sent", {"invitation": invitation})
+        return invitations
+    
+    def _page(self, queryset, before, limit):
+        # seek past the previous page rather than using an OFFSET so later
+        # pages don't have to read and skip all the earlier rows
+        if before is not None:
+            queryset = queryset.filter(Q(sent__lt=before.sent) | Q(sent=before.sent, id__lt=before.id))
+        return list(queryset.select_related("from_user", "to_user").order_by("-sent", "-id")[:limit])
 
 
 class FriendshipInvitation(models.Model):
@@ -182,10 +932,17 @@ class FriendshipInvitation(models.Model):
     to_user = models.ForeignKey(User, related_name="invitations_to")
     message = models.TextField()
     sent = models.DateField(default=datetime.date.today)
-    status = models.CharField(max_length=1, choices=INVITE_STATUS)
+    status = models.CharField(max_length=1, choices=INVITE_STATUS, db_index=True)
     
     objects = FriendshipInvitationManager()
     
+    def __init__(self, *args, **kwargs):
+        super(FriendshipInvitation, self).__init__(*args, **kwargs)
+        # lets the FriendStats handlers tell when a save changes whether the
+        # invitation is pending
+        self._was_pending = self.id is not None and self.status in PENDING_STATUSES
+    
+    @instrumented("friendship_invitation.accept")
     def accept(self):
         if not Friendship.objects.are_friends(self.to_user, self.from_user):
             friendship = Friendship(to_user=self.to_user, from_user=self.from_user)
@@ -193,11 +950,10 @@ class FriendshipInvitation(models.Model):
             self.status = "5"
             self.save()
             if notification:
+                from friends.fanout import notify_connection
                 notification.send([self.from_user], "friends_accept", {"invitation": self})
                 notification.send([self.to_user], "friends_accept_sent", {"invitation": self})
-                for user in friend_set_for(self.to_user) | friend_set_for(self.from_user):
-                    if user != self.to_user and user != self.from_user:
-                        notification.send([user], "friends_otherconnect", {"invitation": self, "to_user": self.to_user})
+                notify_connection(self, self.to_user, self.from_user, to_user=self.to_user)
     
     def decline(self):
         if not Friendship.objects.are_friends(self.to_user, self.from_user):
@@ -217,44 +973,450 @@ class FriendshipInvitationHistory(models.Model):
     status = models.CharField(max_length=1, choices=INVITE_STATUS)
 
 
+class QueuedNotification(models.Model):
+    """
+    A batch of friends_otherconnect notifications waiting to be sent by the
+    send_queued_notifications command (see friends.fanout.QueueExecutor).
+    """
+    
+    label = models.CharField(max_length=40)
+    # comma separated ids of the users to notify
+    recipients = models.TextField()
+    
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    invitation = generic.GenericForeignKey()
+    to_user = models.ForeignKey(User, related_name="queued_notifications")
+    
+    queued = models.DateTimeField(default=datetime.datetime.now)
+    
+    def recipient_ids(self):
+        return [int(user_id) for user_id in self.recipients.split(",") if user_id]
+
+
+IMPORT_SOURCES = (
+    ("vcard", "vCard"),
+    ("yahoo", "Yahoo"),
+    ("google", "Google"),
+)
+
+IMPORT_STATUS = (
+    ("1", "Queued"),
+    ("2", "Running"),
+    ("3", "Completed"),
+    ("4", "Failed"),
+)
+
+
+class ImportJobManager(models.Manager):
+    
+    def enqueue(self, user, source, data):
+        """
+        Queues an import of the given data (vcard text or an auth token,
+        depending on the source) into the contacts of the given user.
+        """
+        return self.create(user=user, source=source, data=data)
+    
+    def claim_next(self):
+        """
+        Marks the oldest queued job as running and returns it, or returns
+        None if there are no queued jobs. Safe to call from several workers
+        at once; each job is only ever claimed by one.
+        
+        Running jobs which haven't recorded progress for
+        FRIENDS_IMPORT_STALE_MINUTES, whose worker is assumed to have died,
+        are claimed again like queued ones.
+        """
+        now = datetime.datetime.now()
+        claimable = Q(status="1") | Q(status="2", heartbeat__lt=now - datetime.timedelta(minutes=FRIENDS_IMPORT_STALE_MINUTES))
+        for job_id in self.filter(claimable).order_by("id").values_list("id", flat=True)[:10]:
+            if self.filter(claimable, id=job_id).update(status="2", started=now, heartbeat=now):
+                return self.get(id=job_id)
+        return None
+
+
+class ImportJob(models.Model):
+    """
+    A contact import run in the background by the process_import_jobs
+    command rather than in the request that asked for it.
+    """
+    
+    user = models.ForeignKey(User, related_name="import_jobs")
+    source = models.CharField(max_length=10, choices=IMPORT_SOURCES)
+    # the vcard text or the auth token for the source
+    data = models.TextField()
+    status = models.CharField(max_length=1, choices=IMPORT_STATUS, default="1", db_index=True)
+    
+    imported = models.PositiveIntegerField(default=0)
+    total = models.PositiveIntegerField(default=0)
+    duplicates = models.PositiveIntegerField(default=0)
+    invalid = models.PositiveIntegerField(default=0)
+    # where an interrupted Google import picks up from
+    checkpoint = models.TextField(blank=True)
+    error = models.TextField(blank=True)
+    
+    created = models.DateTimeField(default=datetime.datetime.now)
+    started = models.DateTimeField(null=True, blank=True)
+    # when the running job last recorded progress
+    heartbeat = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    
+    objects = ImportJobManager()
+    
+    def __unicode__(self):
+        return "%s import for %s" % (self.get_source_display(), self.user)
+    
+    def record_progress(self, result):
+        self.imported, self.total = result
+        self.duplicates, self.invalid = result.duplicates, result.invalid
+        self.heartbeat = datetime.datetime.now()
+        ImportJob.objects.filter(id=self.id).update(
+            imported=self.imported,
+            total=self.total,
+            duplicates=self.duplicates,
+            invalid=self.invalid,
+            heartbeat=self.heartbeat,
+        )
+    
+    def record_checkpoint(self, href):
+        self.checkpoint = href or ""
+        self.heartbeat = datetime.datetime.now()
+        ImportJob.objects.filter(id=self.id).update(checkpoint=self.checkpoint, heartbeat=self.heartbeat)
+    
+    def run(self):
+        """
+        Runs the import, recording progress as it goes and the outcome
+        when it's done.
+        """
+        from friends import importer
+        try:
+            if self.source == "vcard":
+                result = importer.import_vcards(StringIO(self.data), self.user, progress=self.record_progress)
+            elif self.source == "yahoo":
+                result = importer.import_yahoo(self.data, self.user)
+            elif self.source == "google":
+                result = importer.import_google(self.data, self.user,
+                    progress=self.record_progress,
+                    checkpoint=self.record_checkpoint,
+                    resume_from=self.checkpoint or None,
+                )
+            else:
+                raise ValueError("unknown import source %r" % self.source)
+        except Exception:
+            self.status = "4"
+            self.error = traceback.format_exc()
+        else:
+            self.record_progress(result)
+            self.status = "3"
+        self.finished = datetime.datetime.now()
+        ImportJob.objects.filter(id=self.id).update(status=self.status, error=self.error, finished=self.finished)
+    
+    def progress(self):
+        """
+        Returns the job's status and counters for showing to the user.
+        """
+        return {
+            "status": self.get_status_display(),
+            "imported": self.imported,
+            "total": self.total,
+            "duplicates": self.duplicates,
+            "invalid": self.invalid,
+            "done": self.status in ["3", "4"],
+        }
+
+
+class FriendStatsManager(models.Manager):
+    
+    def for_user(self, user):
+        """
+        Returns the stats for the given user, counting them first if the
+        user doesn't have any yet.
+        """
+        try:
+            return self.get(user=_user_id(user))
+        except FriendStats.DoesNotExist:
+            self.rebuild([_user_id(user)])
+            return self.get(user=_user_id(user))
+    
+    def adjust(self, user_id, **deltas):
+        """
+        Atomically adds the given amounts to the named counters of a user,
+        e.g. ``adjust(user_id, friends=1)``.
+        
+        A user without stats only gets them counted when something is added;
+        removals leave them to be counted by ``for_user``, as they may be part
+        of the user themselves being deleted.
+        """
+        updates = dict([(field, F(field) + delta) for field, delta in deltas.items() if delta])
+        if updates and not self.filter(user=user_id).update(**updates):
+            if min(deltas.values()) >= 0:
+                # no stats yet so count everything, including this change
+                self.rebuild([user_id])
+    
+    def adjust_many(self, counter, deltas):
+        """
+        Adds to the named counter of many users at once, given a dictionary
+        mapping user ids to amounts, with one update per distinct amount.
+        Users without stats are handled as in ``adjust``.
+        """
+        user_ids = [user_id for user_id, delta in deltas.items() if delta]
+        if not user_ids:
+            return
+        existing = set(self.filter(user__in=user_ids).values_list("user", flat=True))
+        by_delta = {}
+        for user_id in user_ids:
+            if user_id in existing:
+                by_delta.setdefault(deltas[user_id], []).append(user_id)
+        for delta, delta_user_ids in by_delta.items():
+            self.filter(user__in=delta_user_ids).update(**{counter: F(counter) + delta})
+        # users without stats yet are counted from scratch, which includes
+        # this change, unless it's a removal (see adjust)
+        missing = [user_id for user_id in user_ids if user_id not in existing and deltas[user_id] > 0]
+        if missing:
+            self.rebuild(missing)
+    
+    def compute(self, user_ids):
+        """
+        Returns a dictionary mapping each of the given user ids to a
+        dictionary of their counts, computed from scratch with one grouped
+        query per counter.
+        """
+        counts = dict([(user_id, {"friends": 0, "invitations_in": 0, "invitations_out": 0, "contacts": 0}) for user_id in user_ids])
+        queries = [
+            ("friends", Friendship.objects.filter(from_user__in=user_ids), "from_user"),
+            ("friends", Friendship.objects.filter(to_user__in=user_ids), "to_user"),
+            ("invitations_in", FriendshipInvitation.objects.filter(to_user__in=user_ids, status__in=PENDING_STATUSES), "to_user"),
+            ("invitations_out", FriendshipInvitation.objects.filter(from_user__in=user_ids, status__in=PENDING_STATUSES), "from_user"),
+            ("contacts", Contact.objects.filter(user__in=user_ids), "user"),
+        ]
+        for counter, queryset, field in queries:
+            for row in queryset.values(field).annotate(n=Count("id")).order_by():
+                counts[row[field]][counter] += row["n"]
+        return counts
+    
+    def rebuild(self, user_ids):
+        """
+        Recounts and stores the stats of the given users.
+        """
+        counts = self.compute(user_ids)
+        existing = set(self.filter(user__in=user_ids).values_list("user", flat=True))
+        for user_id, user_counts in counts.items():
+            if user_id in existing:
+                self.filter(user=user_id).update(**user_counts)
+                continue
+            sid = transaction.savepoint()
+            try:
+                self.create(user_id=user_id, **user_counts)
+            except IntegrityError:
+                # created concurrently, so just bring it up to date
+                transaction.savepoint_rollback(sid)
+                self.filter(user=user_id).update(**user_counts)
+            else:
+                transaction.savepoint_commit(sid)
+
+
+class FriendStats(models.Model):
+    """
+    Counts for a user kept up to date as friendships, invitations and
+    contacts come and go, so showing them costs a single row fetch.
+    """
+    
+    user = models.OneToOneField(User, related_name="friend_stats")
+    friends = models.IntegerField(default=0)
+    # pending friendship invitations to and from the user
+    invitations_in = models.IntegerField(default=0)
+    invitations_out = models.IntegerField(default=0)
+    contacts = models.IntegerField(default=0)
+    
+    objects = FriendStatsManager()
+    
+    def __unicode__(self):
+        return "stats for %s" % self.user_id
+
+
+def link_contacts(user, email):
+    """
+    Adds the given user to ``users`` of every contact with the given email
+    address (ignoring case) they aren't already linked to, using one
+    INSERT ... SELECT.
+    """
+    qn = connection.ops.quote_name
+    users_field = Contact._meta.get_field("users")
+    cursor = connection.cursor()
+    sid = transaction.savepoint()
+    try:
+        cursor.execute("""
+            INSERT INTO %(through)s (%(contact_id)s, %(user_id)s)
+            SELECT c.%(id)s, %%s FROM %(contact)s c
+            WHERE c.%(email)s = %%s AND NOT EXISTS (
+                SELECT 1 FROM %(through)s t WHERE t.%(contact_id)s = c.%(id)s AND t.%(user_id)s = %%s
+            )
+        """ % {
+            "through": qn(users_field.m2m_db_table()),
+            "contact": qn(Contact._meta.db_table),
+            "contact_id": qn(users_field.m2m_column_name()),
+            "user_id": qn(users_field.m2m_reverse_name()),
+            "id": qn("id"),
+            "email": qn("normalized_email"),
+        }, [user.pk, normalize_email(email), user.pk])
+    except IntegrityError:
+        # a concurrent verification of the same address got there first
+        transaction.savepoint_rollback(sid)
+    else:
+        transaction.savepoint_commit(sid)
+    transaction.commit_unless_managed()
+
+
 if EmailAddress:
     def new_user(sender, instance, **kwargs):
         if instance.verified:
-            for join_invitation in JoinInvitation.objects.filter(contact__email=instance.email):
-                if join_invitation.status not in ["5", "7"]: # if not accepted or already marked as joined independently
-                    join_invitation.status = "7"
-                    join_invitation.save()
-                    # notification will be covered below
-            for contact in Contact.objects.filter(email=instance.email):
-                contact.users.add(instance.user)
-                # @@@ send notification
+            # if not accepted or already marked as joined independently
+            JoinInvitation.objects.filter(contact__normalized_email=normalize_email(instance.email)).exclude(status__in=["5", "7"]).update(status="7")
+            # notification will be covered below
+            link_contacts(instance.user, instance.email)
+            # @@@ send notification
     
     # only if django-email-notification is installed
     signals.post_save.connect(new_user, sender=EmailAddress)
 
+def friendship_saved(sender, instance, created=False, **kwargs):
+    invalidate_friends_cache(instance.from_user_id, instance.to_user_id)
+    invalidate_are_friends_cache(instance.from_user_id, instance.to_user_id)
+    if created:
+        FriendStats.objects.adjust(instance.from_user_id, friends=1)
+        FriendStats.objects.adjust(instance.to_user_id, friends=1)
+
+
+signals.post_save.connect(friendship_saved, sender=Friendship)
+
+
 def delete_friendship(sender, instance, **kwargs):
-    friendship_invitations = FriendshipInvitation.objects.filter(to_user=instance.to_user, from_user=instance.from_user)
-    for friendship_invitation in friendship_invitations:
-        if friendship_invitation.status != "8":
-            friendship_invitation.status = "8"
-            friendship_invitation.save()
+    delete_invitations(friendship_invitations_q(instance.from_user_id, instance.to_user_id))
 
 
 signals.pre_delete.connect(delete_friendship, sender=Friendship)
 
 
+def friendship_deleted(sender, instance, **kwargs):
+    # invalidated once the row is gone, so a concurrent read can't cache the
+    # friendship again between invalidation and delete
+    invalidate_friends_cache(instance.from_user_id, instance.to_user_id)
+    invalidate_are_friends_cache(instance.from_user_id, instance.to_user_id)
+    FriendStats.objects.adjust(instance.from_user_id, friends=-1)
+    FriendStats.objects.adjust(instance.to_user_id, friends=-1)
+
+
+signals.post_delete.connect(friendship_deleted, sender=Friendship)
+
+
+def delete_invitations(q):
+    """
+    Marks the friendship invitations matching the given Q object deleted,
+    keeping the pending invitation counts in step.
+    """
+    set_invitation_status(FriendshipInvitation.objects.filter(q), "8")
+
+
+def set_invitation_status(invitations, status):
+    """
+    Gives the friendship invitations in the given queryset the given
+    (not pending) status with one UPDATE, keeping the pending invitation
+    counts in step. Returns the number of invitations changed.
+    """
+    invitations = invitations.exclude(status=status)
+    pending = list(invitations.filter(status__in=PENDING_STATUSES).values_list("from_user", "to_user"))
+    changed = invitations.update(status=status)
+    adjust_pending_invitations(pending, -1)
+    return changed
+
+
+def adjust_pending_invitations(pairs, delta):
+    # one update per user however many of the pairs they're in
+    deltas = {}
+    for from_user_id, to_user_id in pairs:
+        deltas.setdefault(from_user_id, {"invitations_out": 0, "invitations_in": 0})["invitations_out"] += delta
+        deltas.setdefault(to_user_id, {"invitations_out": 0, "invitations_in": 0})["invitations_in"] += delta
+    for user_id, user_deltas in deltas.items():
+        FriendStats.objects.adjust(user_id, **user_deltas)
+
+
+def invitation_saved(sender, instance, **kwargs):
+    pending = instance.status in PENDING_STATUSES
+    if pending != instance._was_pending:
+        adjust_pending_invitations([(instance.from_user_id, instance.to_user_id)], pending and 1 or -1)
+        instance._was_pending = pending
+
+
+signals.post_save.connect(invitation_saved, sender=FriendshipInvitation)
+
+
+def invitation_deleted(sender, instance, **kwargs):
+    if instance.status in PENDING_STATUSES:
+        adjust_pending_invitations([(instance.from_user_id, instance.to_user_id)], -1)
+
+
+signals.post_delete.connect(invitation_deleted, sender=FriendshipInvitation)
+
+
+def contact_saved(sender, instance, created=False, **kwargs):
+    if created:
+        FriendStats.objects.adjust(instance.user_id, contacts=1)
+
+
+signals.post_save.connect(contact_saved, sender=Contact)
+
+
+def contact_deleted(sender, instance, **kwargs):
+    FriendStats.objects.adjust(instance.user_id, contacts=-1)
+
+
+signals.post_delete.connect(contact_deleted, sender=Contact)
+
+
+def copy_to_history(cursor, where, params):
+    """
+    Copies the friendship invitations matching the given SQL condition into
+    FriendshipInvitationHistory with one INSERT ... SELECT, returning the
+    number of rows copied.
+    """
+    qn = connection.ops.quote_name
+    columns = ", ".join([qn(f.column) for f in FriendshipInvitationHistory._meta.local_fields if f.name != "id"])
+    cursor.execute("INSERT INTO %s (%s) SELECT %s FROM %s WHERE %s" % (
+        qn(FriendshipInvitationHistory._meta.db_table), columns,
+        columns, qn(FriendshipInvitation._meta.db_table), where,
+    ), params)
+    return cursor.rowcount
+
+
+def archive_invitations(from_user_id, to_user_id):
+    """
+    Moves any invitations from one user to another into
+    FriendshipInvitationHistory using one INSERT ... SELECT and one DELETE,
+    run in the same transaction.
+    """
+    qn = connection.ops.quote_name
+    table = qn(FriendshipInvitation._meta.db_table)
+    where = "%s = %%s AND %s = %%s" % (qn("from_user_id"), qn("to_user_id"))
+    params = [from_user_id, to_user_id]
+    cursor = connection.cursor()
+    try:
+        if copy_to_history(cursor, where, params):
+            cursor.execute("SELECT COUNT(*) FROM %s WHERE %s AND %s IN (%s)" % (
+                table, where, qn("status"), ", ".join(["%s"] * len(PENDING_STATUSES)),
+            ), params + PENDING_STATUSES)
+            pending = cursor.fetchone()[0]
+            cursor.execute("DELETE FROM %s WHERE %s" % (table, where), params)
+            adjust_pending_invitations([(from_user_id, to_user_id)] * pending, -1)
+    except:
+        transaction.rollback_unless_managed()
+        raise
+    transaction.commit_unless_managed()
+
+
 # moves existing friendship invitation from user to user to FriendshipInvitationHistory before saving new invitation
 def friendship_invitation(sender, instance, **kwargs):
-    friendship_invitations = FriendshipInvitation.objects.filter(to_user=instance.to_user, from_user=instance.from_user)
-    for friendship_invitation in friendship_invitations:
-        FriendshipInvitationHistory.objects.create(
-                from_user=friendship_invitation.from_user,
-                to_user=friendship_invitation.to_user,
-                message=friendship_invitation.message,
-                sent=friendship_invitation.sent,
-                status=friendship_invitation.status
-                )
-        friendship_invitation.delete()
+    if instance.id is None:
+        archive_invitations(instance.from_user_id, instance.to_user_id)
 
 
 signals.pre_save.connect(friendship_invitation, sender=FriendshipInvitation)
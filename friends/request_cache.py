@@ -0,0 +1,82 @@
+"""
+Request-scoped memoization of friendship lookups.
+
+While active, FriendshipManager remembers the friendships it has loaded for
+each user, so repeated friend_set_for, friends_for_user and are_friends
+calls for the same users (once per comment author on a page, say) don't go
+back to the cache or the database. Any write to a Friendship clears it.
+
+Turn it on for whole requests with friends.middleware.FriendshipCacheMiddleware
+or around a block of code with::
+
+    with request_cache():
+        ...
+"""
+
+import threading
+
+
+class MemoState(threading.local):
+    
+    def __init__(self):
+        self.memo = None
+        self.depth = 0
+
+_state = MemoState()
+
+
+def active():
+    return _state.memo is not None
+
+
+def get(key, compute):
+    """
+    Returns the value memoized for ``key``, calling ``compute`` to work it
+    out if there isn't one yet. Without an active memo it just calls
+    ``compute``.
+    """
+    memo = _state.memo
+    if memo is None:
+        return compute()
+    try:
+        return memo[key]
+    except KeyError:
+        value = memo[key] = compute()
+        return value
+
+
+def clear():
+    if _state.memo is not None:
+        _state.memo.clear()
+
+
+def begin():
+    # nested blocks share the outermost memo so a write in one clears it
+    # for all of them
+    if _state.memo is None:
+        _state.memo = {}
+    _state.depth += 1
+
+
+def end():
+    _state.depth -= 1
+    if _state.depth <= 0:
+        discard()
+
+
+def discard():
+    _state.memo = None
+    _state.depth = 0
+
+
+class request_cache(object):
+    """
+    Context manager memoizing friendship lookups made within it.
+    """
+    
+    def __enter__(self):
+        begin()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        end()
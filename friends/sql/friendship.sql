@@ -0,0 +1,3 @@
+-- unique_together already indexes (to_user_id, from_user_id); this covers
+-- lookups starting from from_user_id so both sides are index-only scans
+CREATE INDEX friends_friendship_from_user_to_user ON friends_friendship (from_user_id, to_user_id);
@@ -0,0 +1,4 @@
+-- incoming and outgoing inboxes filter by user and status and page by
+-- (sent, id), so both are range scans of these indexes
+CREATE INDEX friends_friendshipinvitation_to_user_status ON friends_friendshipinvitation (to_user_id, status, sent, id);
+CREATE INDEX friends_friendshipinvitation_from_user_status ON friends_friendshipinvitation (from_user_id, status, sent, id);
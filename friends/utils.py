@@ -0,0 +1,65 @@
+from django.db import connection, models, transaction
+
+
+def chunked(iterable, size):
+    """
+    Yields lists of up to ``size`` items from ``iterable`` without
+    materializing the whole iterable.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def normalize_email(email):
+    """
+    Returns the form of ``email`` used to tell whether two addresses are
+    the same.
+    """
+    return (email or "").strip().lower()
+
+
+def in_bulk(model, ids, batch_size=500):
+    """
+    Returns a dictionary mapping the given ids to the model's instances
+    with those ids, as ``in_bulk`` does but loading ``batch_size`` at a
+    time so the query stays within the database's parameter limit.
+    """
+    objs = {}
+    for chunk in chunked(ids, batch_size):
+        objs.update(model._default_manager.in_bulk(chunk))
+    return objs
+
+
+def bulk_insert(model, objs, batch_size=500):
+    """
+    Inserts the given unsaved model instances ``batch_size`` rows at a
+    time, without sending signals.
+    
+    Uses ``bulk_create`` where the manager provides it and otherwise a
+    single ``executemany`` per batch.
+    """
+    manager = model._default_manager
+    if hasattr(manager, "bulk_create"):
+        for chunk in chunked(objs, batch_size):
+            manager.bulk_create(chunk)
+        return
+    qn = connection.ops.quote_name
+    fields = [f for f in model._meta.local_fields if not isinstance(f, models.AutoField)]
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+        qn(model._meta.db_table),
+        ", ".join([qn(f.column) for f in fields]),
+        ", ".join(["%s"] * len(fields)),
+    )
+    cursor = connection.cursor()
+    for chunk in chunked(objs, batch_size):
+        cursor.executemany(sql, [
+            [f.get_db_prep_save(f.pre_save(obj, True), connection=connection) for f in fields]
+            for obj in chunk
+        ])
+    transaction.commit_unless_managed()
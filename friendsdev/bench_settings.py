@@ -0,0 +1,13 @@
+# Settings for benchmarks.py: everything in memory so runs are repeatable.
+
+from settings import *
+
+DEBUG = False
+TEMPLATE_DEBUG = DEBUG
+
+DATABASE_ENGINE = 'sqlite3'
+DATABASE_NAME = ':memory:'
+
+CACHE_BACKEND = 'locmem://'
+
+EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+"""
+Benchmarks of the friends hot paths against a synthetic social graph, run
+with the in-memory bench_settings:
+
+    python benchmarks.py --users 5000 --edges-per-user 10
+
+The graph is grown by preferential attachment, so like a real one it has a
+power-law degree distribution: most users have a few friends and a few
+have very many. Each operation is timed on a sample of users and reported
+with its latency and number of queries, as measured by
+friends.instrumentation.
+
+The importers are run against in-memory fakes of the Yahoo and Google
+services. Without the notification app, accepting an invitation sends no
+notifications, so the fan-out is measured as the query collecting its
+recipients.
+"""
+
+import os
+import random
+from optparse import OptionParser
+from StringIO import StringIO
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "bench_settings")
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.utils import simplejson as json
+
+from django.contrib.auth.models import User
+
+from friends.fanout import connection_recipient_ids
+from friends.forms import InviteFriendForm
+from friends.instrumentation import add_sink, instrumented
+from friends.models import Friendship, FriendshipInvitation, FriendStats, friend_set_for
+from friends.utils import bulk_insert
+
+
+class Recorder(object):
+    """
+    Instrumentation sink keeping every measurement, in order of operation.
+    """
+    
+    def __init__(self):
+        self.names = []
+        self.samples = {}
+    
+    def record(self, name, seconds, queries, db_seconds):
+        if name not in self.samples:
+            self.names.append(name)
+            self.samples[name] = []
+        self.samples[name].append((seconds, queries, db_seconds))
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def report(recorder, names):
+    print "%-36s %6s %9s %9s %9s %9s %8s %8s" % ("operation", "calls", "mean ms", "p50 ms", "p95 ms", "max ms", "queries", "max q")
+    for name in names:
+        samples = recorder.samples.get(name)
+        if not samples:
+            continue
+        times = [seconds * 1000 for seconds, queries, db_seconds in samples]
+        queries = [queries for seconds, queries, db_seconds in samples]
+        print "%-36s %6d %9.2f %9.2f %9.2f %9.2f %8.1f %8d" % (
+            name,
+            len(samples),
+            sum(times) / len(times),
+            percentile(times, 0.5),
+            percentile(times, 0.95),
+            max(times),
+            float(sum(queries)) / len(queries),
+            max(queries),
+        )
+
+
+def measure(name, func, argsets):
+    """
+    Calls ``func`` with each of the given argument tuples, measured as the
+    operation ``name``.
+    """
+    op = instrumented(name)(func)
+    for args in argsets:
+        op(*args)
+    return name
+
+
+# synthetic data
+
+def power_law_edges(users, edges_per_user, rng):
+    """
+    Returns friendships between user indexes 0 to ``users - 1`` grown by
+    preferential attachment: each new user befriends ``edges_per_user``
+    existing users chosen in proportion to how many friends they have.
+    """
+    edges = []
+    # every user appears once per friendship they're in
+    endpoints = []
+    for new in range(1, users):
+        chosen = set()
+        while len(chosen) < min(edges_per_user, new):
+            if endpoints and rng.random() > 0.05:
+                chosen.add(rng.choice(endpoints))
+            else:
+                chosen.add(rng.randrange(new))
+        for existing in chosen:
+            edges.append((existing, new))
+            endpoints.extend((existing, new))
+    return edges
+
+
+def create_graph(users, edges_per_user, rng):
+    bulk_insert(User, [User(username="bench%d" % i, email="bench%d@example.com" % i) for i in range(users)])
+    user_ids = list(User.objects.filter(username__startswith="bench").order_by("id").values_list("id", flat=True))
+    edges = power_law_edges(users, edges_per_user, rng)
+    bulk_insert(Friendship, [Friendship(from_user_id=user_ids[i], to_user_id=user_ids[j]) for i, j in edges])
+    FriendStats.objects.rebuild(user_ids)
+    return user_ids, set([(user_ids[i], user_ids[j]) for i, j in edges])
+
+
+def contact_entries(count, rng):
+    """
+    Returns (name, email) pairs with a few repeated and invalid addresses.
+    """
+    entries = []
+    for i in range(count):
+        roll = rng.random()
+        if roll < 0.05 and entries:
+            name, email = rng.choice(entries)
+            email = email.upper()
+        elif roll < 0.07:
+            name, email = "Nobody %d" % i, "not an address"
+        else:
+            name, email = "Contact %d" % i, "contact%d@example.com" % i
+        entries.append((name, email))
+    return entries
+
+
+def vcard_stream(entries):
+    cards = []
+    for name, email in entries:
+        cards.append("BEGIN:VCARD\r\nVERSION:3.0\r\nFN:%s\r\nEMAIL:%s\r\nEND:VCARD\r\n" % (name, email))
+    return StringIO("".join(cards))
+
+
+class FakeYahooAuth(object):
+    
+    def __init__(self, entries):
+        self.entries = entries
+    
+    def makeAuthWSgetCall(self, url):
+        contacts = []
+        for name, email in self.entries:
+            first, last = name.split(" ", 1)
+            contacts.append({"fields": [{"data": email}, {"first": first, "last": last}]})
+        return json.dumps({"contacts": contacts})
+
+
+class Record(object):
+    
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeFeed(object):
+    
+    def __init__(self, entry, next_href):
+        self.entry = entry
+        self.next_href = next_href
+    
+    def GetNextLink(self):
+        if self.next_href:
+            return Record(href=self.next_href)
+        return None
+
+
+class FakeContactsService(object):
+    
+    def __init__(self, entries, page_size=100):
+        self.entries = [
+            Record(title=Record(text=name), email=[Record(address=email)])
+            for name, email in entries
+        ]
+        self.page_size = page_size
+    
+    def GetContactsFeed(self, uri=None):
+        start = int(uri or 0)
+        end = start + self.page_size
+        return FakeFeed(self.entries[start:end], end < len(self.entries) and str(end) or None)
+
+
+# benchmarks
+
+def run(options):
+    rng = random.Random(options.seed)
+    call_command("syncdb", interactive=False, verbosity=0)
+    recorder = Recorder()
+    add_sink(recorder)
+    
+    user_ids, friendships = create_graph(options.users, options.edges_per_user, rng)
+    degrees = {}
+    for pair in friendships:
+        for user_id in pair:
+            degrees[user_id] = degrees.get(user_id, 0) + 1
+    print "%d users, %d friendships, max %d friends, median %d friends" % (
+        len(user_ids), len(friendships), max(degrees.values()), percentile(degrees.values(), 0.5),
+    )
+    print
+    
+    users = User.objects.in_bulk(user_ids)
+    sample = [users[user_id] for user_id in rng.sample(user_ids, min(options.samples, len(user_ids)))]
+    def are_friends(user1_id, user2_id):
+        return (user1_id, user2_id) in friendships or (user2_id, user1_id) in friendships
+    strangers = []
+    while len(strangers) < options.samples + options.invitations:
+        user1_id, user2_id = rng.sample(user_ids, 2)
+        if not are_friends(user1_id, user2_id):
+            strangers.append((users[user1_id], users[user2_id]))
+    friend_pairs = [(users[i], users[j]) for i, j in rng.sample(sorted(friendships), min(options.samples, len(friendships)))]
+    
+    names = []
+    cache.clear()
+    names.append(measure("friends_for_user (cold)", Friendship.objects.friends_for_user, [(user,) for user in sample]))
+    names.append(measure("friends_for_user (warm)", Friendship.objects.friends_for_user, [(user,) for user in sample]))
+    cache.clear()
+    names.append(measure("friend_set_for (cold)", friend_set_for, [(user,) for user in sample]))
+    cache.clear()
+    names.append(measure("are_friends (friends, cold)", Friendship.objects.are_friends, friend_pairs))
+    names.append(measure("are_friends (strangers, cold)", Friendship.objects.are_friends, strangers[:options.samples]))
+    
+    def validate_invite(from_user, to_user):
+        return InviteFriendForm(from_user, {"to_user": to_user.username, "message": ""}).is_valid()
+    names.append(measure("InviteFriendForm validation", validate_invite, strangers[:options.samples]))
+    
+    invitations = [
+        FriendshipInvitation.objects.create(from_user=from_user, to_user=to_user, message="", status="2")
+        for from_user, to_user in strangers[options.samples:]
+    ]
+    names.append(measure("fan-out recipients", lambda user1, user2: list(connection_recipient_ids(user1, user2)), [
+        (invitation.to_user, invitation.from_user) for invitation in invitations
+    ]))
+    names.append(measure("FriendshipInvitation.accept", FriendshipInvitation.accept, [(invitation,) for invitation in invitations]))
+    
+    try:
+        from friends import importer
+    except ImportError, e:
+        print "skipping the importers: %s" % e
+    else:
+        entries = contact_entries(options.contacts, rng)
+        sampled = set([user.id for user in sample])
+        importers = iter([users[user_id] for user_id in user_ids if user_id not in sampled])
+        runs = range(options.import_runs)
+        names.append(measure("vcard import", importer.import_vcards, [
+            (vcard_stream(entries), importers.next()) for i in runs
+        ]))
+        names.append(measure("Yahoo import", importer.import_yahoo, [
+            (None, importers.next(), FakeYahooAuth(entries)) for i in runs
+        ]))
+        names.append(measure("Google import", lambda user, service: importer.import_google(None, user, contacts_service=service), [
+            (importers.next(), FakeContactsService(entries)) for i in runs
+        ]))
+    
+    report(recorder, names)
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--users", type="int", default=2000, help="Number of users in the graph.")
+    parser.add_option("--edges-per-user", type="int", default=5, help="Friends each new user makes while the graph grows (the average user has twice as many).")
+    parser.add_option("--samples", type="int", default=200, help="Number of users or pairs each operation is timed on.")
+    parser.add_option("--invitations", type="int", default=100, help="Number of invitations accepted.")
+    parser.add_option("--contacts", type="int", default=1000, help="Number of entries per import.")
+    parser.add_option("--import-runs", type="int", default=3, help="Number of times each importer is run.")
+    parser.add_option("--seed", type="int", default=0, help="Random seed, so runs are comparable.")
+    options, args = parser.parse_args()
+    run(options)
+
+
+if __name__ == "__main__":
+    main()
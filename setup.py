@@ -22,6 +22,7 @@ setup(
         'friends': [
             'templates/notification/*/*.html',
             'templates/notification/*/*.txt',
+            'sql/*.sql',
         ]
     },
     zip_safe=False,